@@ -0,0 +1,383 @@
+"""
+Performance measurement for GA4GH packages
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import ast
+import collections
+import importlib
+import os
+import sys
+
+import ga4gh.common.utils as utils
+
+json = utils.lazyImport('json')
+platform = utils.lazyImport('platform')
+shutil = utils.lazyImport('shutil')
+subprocess = utils.lazyImport('subprocess')
+tempfile = utils.lazyImport('tempfile')
+
+
+ImportTime = collections.namedtuple(
+    'ImportTime', ['name', 'selfSeconds', 'cumulativeSeconds', 'depth'])
+
+
+# Run in a fresh interpreter to time each import of a module and its
+# dependencies, like python -X importtime (which Python 2 lacks).  It
+# avoids importing anything that the measured module might import.
+_importTimeScript = """
+import sys
+import time
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+records = []
+nestedSeconds = []
+originalImport = builtins.__import__
+
+
+def timedImport(name, *args, **kwargs):
+    moduleCount = len(sys.modules)
+    nestedSeconds.append(0.0)
+    start = time.time()
+    try:
+        return originalImport(name, *args, **kwargs)
+    finally:
+        cumulative = time.time() - start
+        nested = nestedSeconds.pop()
+        if len(nestedSeconds) > 0:
+            nestedSeconds[-1] += cumulative
+        if len(sys.modules) > moduleCount:
+            records.append(
+                (name, cumulative - nested, cumulative, len(nestedSeconds)))
+
+
+builtins.__import__ = timedImport
+start = time.time()
+__import__({moduleName!r})
+total = time.time() - start
+builtins.__import__ = originalImport
+sys.stdout.write(repr((total, records)))
+"""
+
+
+def measureImportTime(moduleName, repeats=3, python=sys.executable):
+    """
+    Imports moduleName in repeats fresh interpreters, and returns the
+    tuple (totalSeconds, importTimes) for the fastest of them.
+    importTimes holds an ImportTime for each import that loaded new
+    modules, in the order that the imports finished.
+    """
+    script = _importTimeScript.format(moduleName=str(moduleName))
+    # give the interpreters the same module search path as this one
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    best = None
+    for _ in range(repeats):
+        output = subprocess.check_output([python, '-c', script], env=env)
+        totalSeconds, records = ast.literal_eval(output.decode('utf-8'))
+        if best is None or totalSeconds < best[0]:
+            best = (totalSeconds, [ImportTime(*record) for record in records])
+    return best
+
+
+def formatImportTimeReport(importTimes):
+    """
+    Returns a report of the import times in the format of python -X
+    importtime, with times in microseconds
+    """
+    lines = ['import time: self [us] | cumulative | imported package']
+    for importTime in importTimes:
+        lines.append('import time: {:>9} | {:>10} | {}{}'.format(
+            int(importTime.selfSeconds * 1e6),
+            int(importTime.cumulativeSeconds * 1e6),
+            '  ' * importTime.depth, importTime.name))
+    return '\n'.join(lines)
+
+
+def checkImportTimeBudget(moduleName, budgetSeconds, repeats=3):
+    """
+    Measures the time to import moduleName, and throws an AssertionError
+    with the import time report if it is over budgetSeconds
+    """
+    totalSeconds, importTimes = measureImportTime(moduleName, repeats)
+    if totalSeconds > budgetSeconds:
+        msg = "Importing {} took {:.3f}s > budget of {:.3f}s\n{}".format(
+            moduleName, totalSeconds, budgetSeconds,
+            formatImportTimeReport(importTimes))
+        raise AssertionError(msg)
+    return totalSeconds
+
+
+BenchmarkComparison = collections.namedtuple(
+    'BenchmarkComparison',
+    ['name', 'baselineSeconds', 'seconds', 'ratio', 'threshold',
+     'regressed'])
+
+
+class BenchmarkSuite(object):
+    """
+    A named collection of benchmarks.  A benchmark is a function taking
+    (workDir, scale) that prepares its inputs in the empty directory
+    workDir, sized in proportion to scale, and returns the zero
+    argument function to be timed.
+    """
+    def __init__(self):
+        self._benchmarks = collections.OrderedDict()
+
+    def register(self, name, func):
+        if name in self._benchmarks:
+            raise ValueError("Benchmark {} already registered".format(name))
+        self._benchmarks[name] = func
+
+    def getNames(self):
+        return list(self._benchmarks.keys())
+
+    def getBenchmark(self, name):
+        return self._benchmarks[name]
+
+
+benchmarkSuite = BenchmarkSuite()
+
+
+class Benchmark(object):
+    """
+    Decorator that registers a benchmark in suite (by default, the
+    process-wide benchmarkSuite) under name (by default, the function's
+    name).  Other packages register their benchmarks by decorating them
+    in a module passed to ga4gh_run_tests --benchmark-module.
+    """
+    def __init__(self, name=None, suite=None):
+        self.name = name
+        self.suite = suite
+        if self.suite is None:
+            self.suite = benchmarkSuite
+
+    def __call__(self, func):
+        name = self.name
+        if name is None:
+            name = func.__name__
+        self.suite.register(name, func)
+        return func
+
+
+def _timeLoops(func, loops):
+    start = utils._wallClock()
+    for _ in range(loops):
+        func()
+    return utils._wallClock() - start
+
+
+def measure(func, repeats=5, minSeconds=0.1):
+    """
+    Times func like timeit: the number of loops is raised in powers of
+    ten until a run of them takes at least minSeconds, then repeats runs
+    of that many loops are timed.  Returns a dictionary of the fastest
+    and median seconds per call, and the loop and repeat counts.
+    """
+    loops = 1
+    while True:
+        elapsed = _timeLoops(func, loops)
+        if elapsed >= minSeconds or loops >= 10 ** 6:
+            break
+        loops *= 10
+    timings = [elapsed / loops]
+    for _ in range(repeats - 1):
+        timings.append(_timeLoops(func, loops) / loops)
+    timings.sort()
+    return {
+        'seconds': timings[0],
+        'medianSeconds': timings[len(timings) // 2],
+        'loops': loops,
+        'repeats': repeats,
+    }
+
+
+def loadBenchmarkModules(moduleNames):
+    """
+    Imports the named modules so that their benchmarks are registered
+    """
+    for moduleName in moduleNames:
+        importlib.import_module(moduleName)
+
+
+def runBenchmarks(
+        suite=None, names=None, scale=1, repeats=5, minSeconds=0.1):
+    """
+    Runs the named benchmarks (by default, all of them) of suite (by
+    default, benchmarkSuite), and returns the results as a dictionary
+    ready to be saved as JSON
+    """
+    if suite is None:
+        suite = benchmarkSuite
+    if names is None:
+        names = suite.getNames()
+    benchmarks = {}
+    for name in names:
+        workDir = tempfile.mkdtemp(prefix='ga4gh_benchmark_')
+        try:
+            func = suite.getBenchmark(name)(workDir, scale)
+            benchmarks[name] = measure(func, repeats, minSeconds)
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+        utils.log("{}: {:.6f}s per call", name, benchmarks[name]['seconds'])
+    return {
+        'python': sys.version,
+        'platform': platform.platform(),
+        'scale': scale,
+        'benchmarks': benchmarks,
+    }
+
+
+def saveResults(results, filePath):
+    with open(filePath, 'w') as resultsFile:
+        json.dump(results, resultsFile, indent=2, sort_keys=True)
+
+
+def loadResults(filePath):
+    with open(filePath) as resultsFile:
+        return json.load(resultsFile)
+
+
+def compareResults(results, baseline, threshold=0.2, thresholds=None):
+    """
+    Compares the results of runBenchmarks to a baseline from an earlier
+    run, returning a BenchmarkComparison for each benchmark in results.
+    A benchmark has regressed if it is more than threshold (a fraction)
+    slower than its baseline; thresholds maps benchmark names to their
+    own thresholds.  Benchmarks missing from the baseline can't regress.
+    """
+    if thresholds is None:
+        thresholds = {}
+    comparisons = []
+    baselineBenchmarks = baseline['benchmarks']
+    for name in sorted(results['benchmarks']):
+        seconds = results['benchmarks'][name]['seconds']
+        benchmarkThreshold = thresholds.get(name, threshold)
+        baselineSeconds = None
+        ratio = None
+        regressed = False
+        if name in baselineBenchmarks:
+            baselineSeconds = baselineBenchmarks[name]['seconds']
+            if baselineSeconds > 0:
+                ratio = seconds / baselineSeconds
+                regressed = ratio > 1 + benchmarkThreshold
+        comparisons.append(BenchmarkComparison(
+            name, baselineSeconds, seconds, ratio, benchmarkThreshold,
+            regressed))
+    return comparisons
+
+
+def formatComparisonReport(comparisons):
+    """
+    Returns a table of the comparisons, with times in microseconds
+    """
+    lines = ['{:<40} {:>14} {:>14} {:>8}'.format(
+        'benchmark', 'baseline [us]', 'current [us]', 'ratio')]
+    for comparison in comparisons:
+        baseline = '-'
+        ratio = '-'
+        if comparison.baselineSeconds is not None:
+            baseline = '{:.1f}'.format(comparison.baselineSeconds * 1e6)
+        if comparison.ratio is not None:
+            ratio = '{:.2f}'.format(comparison.ratio)
+        lines.append('{:<40} {:>14} {:>14.1f} {:>8}{}'.format(
+            comparison.name, baseline, comparison.seconds * 1e6, ratio,
+            '  REGRESSED' if comparison.regressed else ''))
+    return '\n'.join(lines)
+
+
+# Benchmarks of the ga4gh.common hot paths
+
+def _writeFile(filePath, data):
+    with open(filePath, 'wb') as fileHandle:
+        fileHandle.write(data)
+
+
+@Benchmark('getFilePathsWithExtensionsInDirectory')
+def _benchmarkGetFilePaths(workDir, scale):
+    extensions = ['.py', '.txt', '.yml', '.json']
+    for i in range(10 * scale):
+        dirPath = os.path.join(workDir, 'dir{}'.format(i), 'subdir')
+        os.makedirs(dirPath)
+        for j in range(100):
+            fileName = 'file{}{}'.format(j, extensions[j % len(extensions)])
+            _writeFile(os.path.join(dirPath, fileName), b'')
+    return lambda: utils.getFilePathsWithExtensionsInDirectory(
+        workDir, ['*.py', '*.yml'])
+
+
+@Benchmark('assertFileContentsIdentical')
+def _benchmarkAssertFileContentsIdentical(workDir, scale):
+    line = b'chr1\t12345\tA\tG\t.\tPASS\n'
+    data = line * (8 * 1024 * 1024 * scale // len(line))
+    pathOne = os.path.join(workDir, 'one.txt')
+    pathTwo = os.path.join(workDir, 'two.txt')
+    _writeFile(pathOne, data)
+    _writeFile(pathTwo, data)
+    return lambda: utils.assertFileContentsIdentical(pathOne, pathTwo)
+
+
+def _writeYamlConfig(workDir, scale):
+    filePath = os.path.join(workDir, 'config.yml')
+    with open(filePath, 'w') as yamlFile:
+        for i in range(2000 * scale):
+            yamlFile.write(
+                'entry{0}:\n  name: name{0}\n  values: [1, 2, 3]\n'.format(i))
+    return filePath
+
+
+@Benchmark('getYamlDocument')
+def _benchmarkGetYamlDocument(workDir, scale):
+    filePath = _writeYamlConfig(workDir, scale)
+    return lambda: utils.getYamlDocument(filePath, useCache=False)
+
+
+@Benchmark('getYamlDocument.cached')
+def _benchmarkGetYamlDocumentCached(workDir, scale):
+    filePath = _writeYamlConfig(workDir, scale)
+    # the cache doesn't trust a file modified moments ago
+    mtime = os.stat(filePath).st_mtime - 60
+    os.utime(filePath, (mtime, mtime))
+    return lambda: utils.getYamlDocument(filePath)
+
+
+@Benchmark('runCommand')
+def _benchmarkRunCommand(workDir, scale):
+    return lambda: utils.runCommand('true', silent=True)
+
+
+@Benchmark('captureOutput')
+def _benchmarkCaptureOutput(workDir, scale):
+    lines = ['line {}\n'.format(i) for i in range(100 * scale)]
+
+    def writeLines():
+        sys.stdout.writelines(lines)
+    return lambda: utils.captureOutput(writeLines)
+
+
+@Benchmark('Timed')
+def _benchmarkTimed(workDir, scale):
+    registry = utils.TimingRegistry()
+    return utils.Timed(report=False, registry=registry)(lambda: None)
+
+
+@Benchmark('Repeat')
+def _benchmarkRepeat(workDir, scale):
+    # ten runs per call, so the per-run loop overhead shows up
+    runs = []
+
+    @utils.Repeat(sleepSeconds=0)
+    def repeated():
+        runs.append(None)
+        return len(runs) % 10 != 0
+    return repeated
+
+
+@Benchmark('Timeout')
+def _benchmarkTimeout(workDir, scale):
+    return utils.Timeout(60)(lambda: None)
@@ -5,38 +5,600 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import os
+import re
+import sys
+import time
+
 import ga4gh.common
+import ga4gh.common.benchmark as benchmark
 import ga4gh.common.cli as cli
 import ga4gh.common.utils as utils
 
+hashlib = utils.lazyImport('hashlib')
+json = utils.lazyImport('json')
+multiprocessingPool = utils.lazyImport('multiprocessing.pool')
+resource = utils.lazyImport('resource')
+shlex = utils.lazyImport('shlex')
+subprocess = utils.lazyImport('subprocess')
+tempfile = utils.lazyImport('tempfile')
+xmlElementTree = utils.lazyImport('xml.etree.ElementTree')
+
+
+CommandUsage = collections.namedtuple(
+    'CommandUsage',
+    ['command', 'returncode', 'wallSeconds', 'userSeconds', 'systemSeconds',
+     'maxRssBytes', 'runnerMaxRssBytes', 'cached'])
+
+
+def _getMaxRssBytes(rusage):
+    # ru_maxrss is in bytes on OS X, but kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+
+def _getRunnerMaxRssBytes():
+    """
+    Returns the peak RSS of this process, which Linux carries across
+    fork and exec into the peak RSS of every command it runs, or 0 on
+    other platforms
+    """
+    if not sys.platform.startswith('linux'):
+        return 0
+    return _getMaxRssBytes(resource.getrusage(resource.RUSAGE_SELF))
+
+
+def _isRunnerRss(usage):
+    """
+    Returns True if the command's peak RSS is no more than that of the
+    runner when it started the command, in which case the command's own
+    peak is unknown, but no larger
+    """
+    return (not usage.cached and usage.runnerMaxRssBytes > 0 and
+            usage.maxRssBytes <= usage.runnerMaxRssBytes)
+
+
+def _waitForUsage(proc, command, start, runnerMaxRssBytes):
+    """
+    Reaps the finished process with wait4, returning its CommandUsage
+    """
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    # stop Popen from trying to reap the process again
+    proc.returncode = returncode
+    return CommandUsage(
+        command, returncode, time.time() - start, rusage.ru_utime,
+        rusage.ru_stime, _getMaxRssBytes(rusage), runnerMaxRssBytes, False)
+
+
+def _runTestCommand(command, echo=False):
+    """
+    Runs a test command, returning the tuple (usage, output), where
+    usage is the command's CommandUsage and output holds its interleaved
+    stdout and stderr.  If echo is set, the output is also written to
+    stdout as it arrives.
+    """
+    start = time.time()
+    runnerMaxRssBytes = _getRunnerMaxRssBytes()
+    try:
+        proc = subprocess.Popen(
+            shlex.split(command), stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    except OSError as exception:
+        if exception.errno == 2:  # cmd not found
+            output = "Can't find command while trying to run {}\n".format(
+                command)
+            if echo:
+                sys.stdout.write(output)
+            usage = CommandUsage(
+                command, 127, time.time() - start, 0, 0, 0, 0, False)
+            return usage, output
+        raise
+    if not echo:
+        output = proc.stdout.read()
+    else:
+        chunks = []
+        for line in iter(proc.stdout.readline, b''):
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            chunks.append(line)
+        output = b''.join(chunks)
+    proc.stdout.close()
+    return _waitForUsage(proc, command, start, runnerMaxRssBytes), output
+
+
+class TestResultCache(object):
+    """
+    An on-disk cache of the output of successful test commands.  An
+    entry is keyed on the command, the contents of every file in the
+    tree matching one of the patterns, and the interpreter version, so
+    a hit means the command would do exactly what it did last time.
+    """
+    defaultDirectory = '.ga4gh_run_tests_cache'
+    defaultPatterns = ['*.py', '*.yml', '*.yaml', '*.cfg', '*.ini', '*.txt']
+    # directories holding tools and build output rather than sources
+    defaultExcludeDirs = [
+        '.git', '.tox', '.nox', 'venv', '.venv', '*.egg-info']
+    defaultMaxBytes = 16 * 1024 * 1024
+    entrySuffix = '.json'
+
+    def __init__(
+            self, directory=defaultDirectory, patterns=defaultPatterns,
+            maxBytes=defaultMaxBytes, treeRoot='.',
+            excludeDirs=defaultExcludeDirs):
+        self.directory = directory
+        self.patterns = patterns
+        self.excludeDirs = excludeDirs
+        self.maxBytes = maxBytes
+        self.treeRoot = treeRoot
+        self._treeDigest = None
+
+    def _getTreeDigest(self):
+        # the tree is hashed once per run; commands in the run are not
+        # expected to change the files that other commands depend on
+        if self._treeDigest is None:
+            digest = hashlib.sha1()
+            digest.update(sys.version.encode('utf-8'))
+            cacheDirectory = os.path.abspath(self.directory)
+            filePaths = utils.getFilePathsWithExtensionsInDirectory(
+                self.treeRoot, self.patterns, excludeDirs=self.excludeDirs)
+            for filePath in filePaths:
+                if os.path.abspath(filePath).startswith(cacheDirectory):
+                    continue
+                digest.update(filePath.encode('utf-8'))
+                with open(filePath, 'rb') as fileHandle:
+                    for block in iter(lambda: fileHandle.read(65536), b''):
+                        digest.update(block)
+            self._treeDigest = digest.hexdigest()
+        return self._treeDigest
+
+    def _getEntryPath(self, command):
+        digest = hashlib.sha1(self._getTreeDigest().encode('utf-8'))
+        digest.update(command.encode('utf-8'))
+        return os.path.join(
+            self.directory, digest.hexdigest() + self.entrySuffix)
+
+    def get(self, command):
+        """
+        Returns the stored output of command, or None on a cache miss
+        """
+        entryPath = self._getEntryPath(command)
+        try:
+            with open(entryPath) as entryFile:
+                entry = json.load(entryFile)
+        except (IOError, ValueError):
+            return None
+        if entry.get('command') != command:
+            return None
+        # mark the entry as recently used for eviction purposes
+        os.utime(entryPath, None)
+        return entry['output'].encode('utf-8')
+
+    def put(self, command, output):
+        """
+        Stores the output of a successful run of command
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        entry = {
+            'command': command,
+            'output': output.decode('utf-8', 'replace'),
+        }
+        # write then rename so concurrent readers never see a partial entry
+        handle, tempPath = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, 'w') as tempFile:
+            json.dump(entry, tempFile)
+        os.rename(tempPath, self._getEntryPath(command))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache is no
+        larger than maxBytes
+        """
+        entries = []
+        totalBytes = 0
+        for fileName in os.listdir(self.directory):
+            if not fileName.endswith(self.entrySuffix):
+                continue
+            entryPath = os.path.join(self.directory, fileName)
+            stat = os.stat(entryPath)
+            entries.append((stat.st_mtime, stat.st_size, entryPath))
+            totalBytes += stat.st_size
+        entries.sort()
+        for _, size, entryPath in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(entryPath)
+            totalBytes -= size
+
+
+class CommandHistory(object):
+    """
+    The wall clock times of the successful test commands of the last
+    maxRuns runs, kept in a JSON file so that a command which has become
+    slower than usual can be flagged
+    """
+    defaultFilePath = os.path.join(TestResultCache.defaultDirectory, 'history')
+    defaultMaxRuns = 20
+    # a command is flagged if it is this fraction slower than its median
+    defaultSlowdownThreshold = 0.5
+
+    def __init__(
+            self, filePath=defaultFilePath, maxRuns=defaultMaxRuns,
+            slowdownThreshold=defaultSlowdownThreshold):
+        self.filePath = filePath
+        self.maxRuns = maxRuns
+        self.slowdownThreshold = slowdownThreshold
+
+    def _load(self):
+        try:
+            with open(self.filePath) as historyFile:
+                return json.load(historyFile)
+        except (IOError, ValueError):
+            return []
+
+    def getMedianSeconds(self, command):
+        """
+        Returns the median wall clock time of the command over the
+        recorded runs, or None if it has not been recorded
+        """
+        seconds = sorted(
+            run[command] for run in self._load() if command in run)
+        if len(seconds) == 0:
+            return None
+        return seconds[len(seconds) // 2]
+
+    def findSlowdowns(self, usages):
+        """
+        Returns the list of tuples (usage, medianSeconds) for the usages
+        of commands that ran more than slowdownThreshold slower than
+        their median
+        """
+        slowdowns = []
+        for usage in usages:
+            if usage.cached or usage.returncode != 0:
+                continue
+            medianSeconds = self.getMedianSeconds(usage.command)
+            if medianSeconds is None:
+                continue
+            if usage.wallSeconds > medianSeconds * (
+                    1 + self.slowdownThreshold):
+                slowdowns.append((usage, medianSeconds))
+        return slowdowns
+
+    def record(self, usages):
+        """
+        Adds a run with the usages of its successful, uncached commands
+        """
+        run = dict(
+            (usage.command, usage.wallSeconds) for usage in usages
+            if not usage.cached and usage.returncode == 0)
+        if len(run) == 0:
+            return
+        runs = self._load()
+        runs.append(run)
+        directory = os.path.dirname(self.filePath)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, tempPath = tempfile.mkstemp(dir=directory or '.')
+        with os.fdopen(handle, 'w') as tempFile:
+            json.dump(runs[-self.maxRuns:], tempFile)
+        os.rename(tempPath, self.filePath)
+
+
+def formatUsageTable(usages):
+    """
+    Returns a table of the usages, slowest command first.  A peak RSS
+    that may be the runner's own rather than the command's is shown as
+    "<=" the runner's.
+    """
+    lines = ['{:>9} {:>9} {:>9} {:>9} {:>6}  {}'.format(
+        'wall [s]', 'user [s]', 'sys [s]', 'rss [MB]', 'status', 'command')]
+    anyRunnerRss = False
+    for usage in sorted(usages, key=lambda usage: -usage.wallSeconds):
+        status = 'cached' if usage.cached else usage.returncode
+        rss = '{:.1f}'.format(usage.maxRssBytes / (1024 * 1024))
+        if _isRunnerRss(usage):
+            rss = '<={:.1f}'.format(usage.runnerMaxRssBytes / (1024 * 1024))
+            anyRunnerRss = True
+        lines.append('{:>9.2f} {:>9.2f} {:>9.2f} {:>9} {:>6}  {}'.format(
+            usage.wallSeconds, usage.userSeconds, usage.systemSeconds,
+            rss, status, usage.command))
+    if anyRunnerRss:
+        lines.append(
+            '<=: the peak RSS is no more than the runner\'s, which Linux '
+            'counts in every command\'s')
+    return '\n'.join(lines)
+
+
+def writeUsageReport(usages, filePath):
+    """
+    Writes the usages to filePath as a JUnit XML report if its name ends
+    in .xml, and as JSON otherwise.  maxRssIsRunners marks the usages
+    whose peak RSS may be the runner's rather than the command's.
+    """
+    if not filePath.endswith('.xml'):
+        with open(filePath, 'w') as reportFile:
+            json.dump(
+                [dict(usage._asdict(), maxRssIsRunners=_isRunnerRss(usage))
+                 for usage in usages], reportFile, indent=2)
+        return
+    failures = [usage for usage in usages if usage.returncode != 0]
+    suite = xmlElementTree.Element('testsuite', {
+        'name': 'ga4gh_run_tests',
+        'tests': str(len(usages)),
+        'failures': str(len(failures)),
+        'time': '{:.3f}'.format(sum(usage.wallSeconds for usage in usages)),
+    })
+    for usage in usages:
+        testCase = xmlElementTree.SubElement(suite, 'testcase', {
+            'classname': 'ga4gh_run_tests',
+            'name': usage.command,
+            'time': '{:.3f}'.format(usage.wallSeconds),
+        })
+        if usage.returncode != 0:
+            xmlElementTree.SubElement(testCase, 'failure', {
+                'message': 'exit status {}'.format(usage.returncode)})
+        properties = xmlElementTree.SubElement(testCase, 'properties')
+        for name in [
+                'userSeconds', 'systemSeconds', 'maxRssBytes',
+                'runnerMaxRssBytes', 'cached']:
+            xmlElementTree.SubElement(properties, 'property', {
+                'name': name, 'value': str(getattr(usage, name))})
+        xmlElementTree.SubElement(properties, 'property', {
+            'name': 'maxRssIsRunners', 'value': str(_isRunnerRss(usage))})
+    xmlElementTree.ElementTree(suite).write(
+        filePath, encoding='utf-8', xml_declaration=True)
+
 
 class TravisSimulator(object):
 
     logStrPrefix = '***'
     yamlFileLocation = '.travis.yml'
+    # a quoted script entry ending in "# stage: N" is assigned to stage
+    # N; bash treats the annotation as a comment, so Travis ignores it
+    stageAnnotationRegex = re.compile(r'\s*#\s*stage:\s*(\d+)\s*$')
+    defaultStage = 0
+
+    def __init__(self, jobs=1, cache=None, history=None, reportPath=None):
+        self.jobs = jobs
+        self.cache = cache
+        self.history = history
+        self.reportPath = reportPath
+        self.usages = []
 
     def parseTestCommands(self):
         yamlData = utils.getYamlDocument(self.yamlFileLocation)
         return yamlData['script']
 
+    def parseTestStages(self):
+        """
+        Returns the test commands grouped into stages, in the order that
+        the stages must run.  Commands within one stage are independent
+        of each other; unannotated commands are in the default stage.
+        """
+        stages = {}
+        for command in self.parseTestCommands():
+            stage = self.defaultStage
+            match = self.stageAnnotationRegex.search(command)
+            if match is not None:
+                stage = int(match.group(1))
+                command = command[:match.start()]
+            stages.setdefault(stage, []).append(command)
+        return [stages[key] for key in sorted(stages)]
+
     def runTests(self):
-        testCommands = self.parseTestCommands()
-        for command in testCommands:
-            self.log('Running: "{}"'.format(command))
-            utils.runCommand(command)
+        stages = self.parseTestStages()
+        self.usages = []
+        pool = None
+        if self.jobs > 1:
+            pool = multiprocessingPool.ThreadPool(self.jobs)
+        try:
+            for commands in stages:
+                self._runStage(commands, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            self._reportUsages()
         self.log('SUCCESS')
 
+    def _reportUsages(self):
+        if len(self.usages) == 0:
+            return
+        self.log('Resource usage:')
+        print(formatUsageTable(self.usages))
+        if self.reportPath is not None:
+            writeUsageReport(self.usages, self.reportPath)
+        if self.history is not None:
+            for usage, medianSeconds in self.history.findSlowdowns(
+                    self.usages):
+                self.log(
+                    'SLOWER THAN USUAL ({:.2f}s, median {:.2f}s): '
+                    '"{}"'.format(
+                        usage.wallSeconds, medianSeconds, usage.command))
+            self.history.record(self.usages)
+
+    def _runStage(self, commands, pool):
+        if pool is None:
+            self._runStageSerially(commands)
+        else:
+            self._runStageInPool(commands, pool)
+
+    def _getCachedOutput(self, command):
+        if self.cache is None:
+            return None
+        output = self.cache.get(command)
+        if output is not None:
+            self.log('Cached: "{}"'.format(command))
+            self.usages.append(
+                CommandUsage(command, 0, 0, 0, 0, 0, 0, True))
+            sys.stdout.write(output)
+            sys.stdout.flush()
+        return output
+
+    def _recordResult(self, command, usage, output):
+        self.usages.append(usage)
+        if usage.returncode == 0:
+            if self.cache is not None:
+                self.cache.put(command, output)
+            return True
+        self.log('FAILED (exit status {}): "{}"'.format(
+            usage.returncode, command))
+        return False
+
+    def _runStageSerially(self, commands):
+        # like Travis, stop at the first failing command
+        for command in commands:
+            if self._getCachedOutput(command) is not None:
+                continue
+            self.log('Running: "{}"'.format(command))
+            usage, output = _runTestCommand(command, echo=True)
+            if not self._recordResult(command, usage, output):
+                raise subprocess.CalledProcessError(usage.returncode, command)
+
+    def _runStageInPool(self, commands, pool):
+        # the commands of a stage are independent, so all of them run and
+        # every failure is reported
+        pendingCommands = [
+            command for command in commands
+            if self._getCachedOutput(command) is None]
+        for command in pendingCommands:
+            self.log('Queued: "{}"'.format(command))
+        results = pool.map(_runTestCommand, pendingCommands)
+        failures = []
+        for command, (usage, output) in zip(pendingCommands, results):
+            self.log('Output of: "{}"'.format(command))
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if not self._recordResult(command, usage, output):
+                failures.append((command, usage.returncode))
+        if len(failures) > 0:
+            command, returncode = failures[0]
+            raise subprocess.CalledProcessError(returncode, command)
+
     def log(self, logStr):
         utils.log("{0} {1}".format(self.logStrPrefix, logStr))
 
 
+def _parseThresholds(thresholdStrings):
+    thresholds = {}
+    for thresholdString in thresholdStrings:
+        name, _, fraction = thresholdString.rpartition('=')
+        thresholds[name] = float(fraction)
+    return thresholds
+
+
+def runBenchmarks(args):
+    """
+    Runs the benchmarks selected by the command line arguments, saving
+    and comparing the results as requested.  Returns the list of
+    regressed BenchmarkComparisons.
+    """
+    benchmark.loadBenchmarkModules(args.benchmark_module)
+    results = benchmark.runBenchmarks(
+        names=args.benchmark_names, scale=args.benchmark_scale,
+        repeats=args.benchmark_repeats)
+    if args.benchmark_output is not None:
+        benchmark.saveResults(results, args.benchmark_output)
+    if args.benchmark_baseline is None:
+        return []
+    comparisons = benchmark.compareResults(
+        results, benchmark.loadResults(args.benchmark_baseline),
+        args.benchmark_threshold,
+        _parseThresholds(args.benchmark_name_threshold))
+    print(benchmark.formatComparisonReport(comparisons))
+    return [comparison for comparison in comparisons if comparison.regressed]
+
+
 def run_tests_main():
     parser = cli.createArgumentParser("runs tests for a ga4gh package")
     versionString = "GA4GH Runtests Version {}".format(
         ga4gh.common.__version__)
     parser.add_argument(
         "--version", version=versionString, action="version")
-    parser.parse_args()
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="the number of independent test commands to run at once")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="run every test command, ignoring cached results")
+    parser.add_argument(
+        "--cache-patterns", nargs="+",
+        default=TestResultCache.defaultPatterns,
+        help="the file patterns whose contents key the result cache")
+    parser.add_argument(
+        "--cache-exclude-dirs", nargs="*",
+        default=TestResultCache.defaultExcludeDirs,
+        help="the directory patterns whose files don't key the result "
+        "cache")
+    parser.add_argument(
+        "--report", default=None,
+        help="a file to write each command's resource usage to, as JUnit "
+        "XML if its name ends in .xml and as JSON otherwise.  On Linux a "
+        "command's maxRssBytes includes the runner's RSS when it started "
+        "the command, given as runnerMaxRssBytes.")
+    parser.add_argument(
+        "--no-history", action="store_true",
+        help="don't record command times, or flag slower commands")
+    parser.add_argument(
+        "--slowdown-threshold", type=float,
+        default=CommandHistory.defaultSlowdownThreshold,
+        help="the fraction by which a command may be slower than its "
+        "median time before it is flagged")
+    parser.add_argument(
+        "--benchmark", action="store_true",
+        help="run the benchmarks instead of the tests")
+    parser.add_argument(
+        "--benchmark-module", action="append", default=[],
+        help="a module whose benchmarks to run as well as the built in "
+        "ones (may be repeated)")
+    parser.add_argument(
+        "--benchmark-names", nargs="+", default=None,
+        help="the benchmarks to run (default: all of them)")
+    parser.add_argument(
+        "--benchmark-scale", type=int, default=1,
+        help="the factor by which to scale the benchmark inputs")
+    parser.add_argument(
+        "--benchmark-repeats", type=int, default=5,
+        help="the number of timed runs of each benchmark")
+    parser.add_argument(
+        "--benchmark-output", default=None,
+        help="the JSON file to save the benchmark results to")
+    parser.add_argument(
+        "--benchmark-baseline", default=None,
+        help="a JSON file of earlier results to compare against")
+    parser.add_argument(
+        "--benchmark-threshold", type=float, default=0.2,
+        help="the fraction by which a benchmark may be slower than its "
+        "baseline before it counts as a regression")
+    parser.add_argument(
+        "--benchmark-name-threshold", action="append", default=[],
+        metavar="NAME=FRACTION",
+        help="the regression threshold of one benchmark (may be repeated)")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        regressions = runBenchmarks(args)
+        if len(regressions) > 0:
+            utils.log("{} benchmarks regressed", len(regressions))
+            sys.exit(1)
+        return
 
-    travisSimulator = TravisSimulator()
+    cache = None
+    if not args.no_cache:
+        cache = TestResultCache(
+            patterns=args.cache_patterns,
+            excludeDirs=args.cache_exclude_dirs)
+    history = None
+    if not args.no_history:
+        history = CommandHistory(slowdownThreshold=args.slowdown_threshold)
+    travisSimulator = TravisSimulator(
+        jobs=args.jobs, cache=cache, history=history, reportPath=args.report)
     travisSimulator.runTests()
@@ -5,26 +5,334 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import StringIO
+import Queue
+import collections
 import contextlib
+import copy
 import fnmatch
 import functools
-import humanize
+import importlib
+import io
 import itertools
+import logging
 import os
-import shlex
-import signal
-import subprocess
+import re
 import sys
+import threading
 import time
-import yaml
 
 
-def log(message):
+class LazyModule(object):
     """
-    Log a message
+    A stand-in for a module that is only imported when one of its
+    attributes is first used, so that importing a module that uses it
+    does not pay for importing it
     """
-    print(message)
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self._name)
+            self.__dict__['_module'] = module
+        return getattr(module, attr)
+
+
+def lazyImport(name):
+    """
+    Returns a LazyModule standing in for the named module
+    """
+    return LazyModule(name)
+
+
+ctypes = lazyImport('ctypes')
+gzip = lazyImport('gzip')
+hashlib = lazyImport('hashlib')
+humanize = lazyImport('humanize')
+json = lazyImport('json')
+mmap = lazyImport('mmap')
+multiprocessingPool = lazyImport('multiprocessing.pool')
+random = lazyImport('random')
+shlex = lazyImport('shlex')
+signal = lazyImport('signal')
+sqlite3 = lazyImport('sqlite3')
+subprocess = lazyImport('subprocess')
+tempfile = lazyImport('tempfile')
+yaml = lazyImport('yaml')
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+
+def _getYamlLoader():
+    # the C loader is much faster, but is only available if PyYAML was
+    # built against libyaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+_yamlItemLoader = None
+
+
+def _getYamlItemLoader():
+    """
+    Returns a safe loader class that can compose and construct nodes
+    one at a time.  If possible, it pairs the C parser with the Python
+    composer.
+    """
+    global _yamlItemLoader
+    if _yamlItemLoader is None:
+        if yaml.__with_libyaml__:
+            cyaml = importlib.import_module('yaml.cyaml')
+
+            class YamlItemLoader(
+                    cyaml.CParser, yaml.composer.Composer,
+                    yaml.constructor.SafeConstructor, yaml.resolver.Resolver):
+                def __init__(self, stream):
+                    cyaml.CParser.__init__(self, stream)
+                    yaml.composer.Composer.__init__(self)
+                    yaml.constructor.SafeConstructor.__init__(self)
+                    yaml.resolver.Resolver.__init__(self)
+            _yamlItemLoader = YamlItemLoader
+        else:
+            _yamlItemLoader = yaml.SafeLoader
+    return _yamlItemLoader
+
+
+class _BraceMessage(object):
+    """
+    A log message that is only formatted, with str.format, if it is
+    emitted
+    """
+    def __init__(self, message, args, kwargs):
+        self.message = message
+        self.args = args
+        self.kwargs = kwargs
+
+    def __unicode__(self):
+        return unicode(self.message).format(*self.args, **self.kwargs)
+
+    def __str__(self):
+        # logging calls str() on the message, which must not fail for
+        # non-ASCII text
+        return unicode(self).encode('utf-8')
+
+
+class _PrintHandler(logging.Handler):
+    """
+    A logging handler that prints each record, as log always has
+    """
+    def emit(self, record):
+        try:
+            message = self.format(record)
+            # byte messages are printed unchanged, as they always were;
+            # a file with no encoding (such as a pipe) can only take
+            # unicode that is ASCII, so the rest is written as UTF-8
+            if (isinstance(message, unicode) and
+                    getattr(sys.stdout, 'encoding', '') is None):
+                message = message.encode('utf-8')
+            print(message)
+        except Exception:
+            self.handleError(record)
+
+
+class _JsonFormatter(logging.Formatter):
+    """
+    Formats each record as one line of JSON
+    """
+    def format(self, record):
+        document = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            document['exception'] = record.exc_text
+        return json.dumps(document, sort_keys=True)
+
+
+class _QueueHandler(logging.Handler):
+    """
+    A logging handler that hands records to a background thread, which
+    emits them through the wrapped handler, so that logging never
+    blocks the caller on slow output
+    """
+    _stop = object()
+    _exceptionFormatter = logging.Formatter()
+
+    def __init__(self, handler):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        # format the message and any traceback now, since the arguments
+        # may change (and the traceback go away) before the background
+        # thread gets to them; the record may be shared with other
+        # handlers, so a copy is queued
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exceptionFormatter.formatException(
+                    record.exc_info)
+            record.exc_info = None
+        self._queue.put(record)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is self._stop:
+                break
+            self.handler.handle(record)
+
+    def close(self):
+        """
+        Emits all pending records before closing
+        """
+        self._queue.put(self._stop)
+        self._thread.join()
+        self.handler.close()
+        logging.Handler.close(self)
+
+
+_logger = logging.getLogger('ga4gh.common')
+
+
+def configureLogging(level=logging.INFO, structured=False, asynchronous=False):
+    """
+    Configures the logger behind log: messages below level are dropped,
+    structured messages are printed as JSON lines, and asynchronous
+    messages are printed from a background thread
+    """
+    for handler in list(_logger.handlers):
+        _logger.removeHandler(handler)
+        handler.close()
+    handler = _PrintHandler()
+    if structured:
+        handler.setFormatter(_JsonFormatter())
+    if asynchronous:
+        handler = _QueueHandler(handler)
+    _logger.addHandler(handler)
+    _logger.setLevel(level)
+    _logger.propagate = False
+
+
+def log(message, *args, **kwargs):
+    """
+    Log a message.  If args or kwargs are given, the message is
+    formatted with them (as with str.format) only if it is emitted.
+    The level keyword argument gives the message's logging level, which
+    defaults to INFO.
+    """
+    level = kwargs.pop('level', logging.INFO)
+    if not _logger.isEnabledFor(level):
+        return
+    if args or kwargs:
+        message = _BraceMessage(message, args, kwargs)
+    _logger.log(level, message)
+
+
+# leave alone a logger that the application configured before import
+if not _logger.handlers:
+    configureLogging()
+
+
+class _ExecutableIndex(object):
+    """
+    An index of the executables on the PATH.  Each PATH directory is
+    listed once and its listing reused until its mtime (or the PATH
+    itself) changes, so a lookup costs one stat per PATH directory no
+    matter how many executables are resolved.  Only successful lookups
+    are remembered, so an executable that is added or made executable
+    later is still found.
+    """
+    # as in FileIndex, a directory modified this close to being listed
+    # may change again within the same mtime tick, so it is relisted
+    racyWindowSeconds = 2
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path = None
+        self._directories = []
+        self._listings = {}
+        self._resolved = {}
+
+    def _refresh(self):
+        path = os.environ.get('PATH', '')
+        changed = path != self._path
+        directories = path.split(':')
+        for directory in set(directories):
+            # an empty PATH entry means the current directory
+            listDirectory = directory or os.curdir
+            listing = self._listings.get(directory)
+            try:
+                mtime = os.stat(listDirectory).st_mtime
+            except OSError:
+                mtime = None
+            if listing is not None and listing[0] == mtime:
+                continue
+            names = frozenset()
+            if mtime is not None:
+                try:
+                    names = frozenset(os.listdir(listDirectory))
+                except OSError:
+                    pass
+                if time.time() - mtime < self.racyWindowSeconds:
+                    mtime = None
+            self._listings[directory] = (mtime, names)
+            changed = True
+        if changed:
+            self._path = path
+            self._directories = directories
+            self._resolved = {}
+
+    def _find(self, executable):
+        for directory in self._directories:
+            # names with a path separator can't be found in a listing
+            if os.sep not in executable:
+                if executable not in self._listings[directory][1]:
+                    continue
+            exe_file = os.path.join(directory, executable)
+            if os.path.isfile(exe_file) and os.access(exe_file, os.X_OK):
+                return exe_file
+        return None
+
+    def resolve(self, executables):
+        """
+        Returns a dictionary mapping each of the executables to its
+        full path, or to None if it is not on the PATH.  As in the
+        shell, the first matching PATH directory wins.
+        """
+        with self._lock:
+            self._refresh()
+            paths = {}
+            for executable in executables:
+                path = self._resolved.get(executable)
+                if path is None or not os.access(path, os.X_OK):
+                    path = self._find(executable)
+                    if path is None:
+                        self._resolved.pop(executable, None)
+                    else:
+                        self._resolved[executable] = path
+                paths[executable] = path
+            return paths
+
+
+_executableIndex = _ExecutableIndex()
 
 
 def getPathOfExecutable(executable):
@@ -32,12 +340,15 @@ def getPathOfExecutable(executable):
     Returns the full path of the executable, or None if the executable
     can not be found.
     """
-    exe_paths = os.environ['PATH'].split(':')
-    for exe_path in exe_paths:
-        exe_file = os.path.join(exe_path, executable)
-        if os.path.isfile(exe_file) and os.access(exe_file, os.X_OK):
-            return exe_file
-    return None
+    return _executableIndex.resolve([executable])[executable]
+
+
+def getPathsOfExecutables(executables):
+    """
+    Returns a dictionary mapping each of the executables to its full
+    path, or to None if the executable can not be found.
+    """
+    return _executableIndex.resolve(executables)
 
 
 def requireExecutables(executables):
@@ -46,10 +357,10 @@ def requireExecutables(executables):
     If at least one of them is not, exit the script and inform
     the user of the missing requirement(s).
     """
-    missingExecutables = []
-    for executable in executables:
-        if getPathOfExecutable(executable) is None:
-            missingExecutables.append(executable)
+    paths = getPathsOfExecutables(executables)
+    missingExecutables = [
+        executable for executable in executables
+        if paths[executable] is None]
     if len(missingExecutables) > 0:
         log("In order to run this script, the following "
             "executables need to be on the path:")
@@ -75,10 +386,88 @@ def runCommandReturnOutput(cmd):
         splits, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = proc.communicate()
     if proc.returncode != 0:
-        raise subprocess.CalledProcessError(stdout, stderr)
+        raise subprocess.CalledProcessError(
+            proc.returncode, splits, output=stdout + stderr)
     return stdout, stderr
 
 
+class _TailBuffer(object):
+    """
+    Retains (at least) the last maxBytes bytes written to it
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self._chunks = collections.deque()
+        self._size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        while (len(self._chunks) > 1 and
+               self._size - len(self._chunks[0]) >= self.maxBytes):
+            self._size -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        value = b''.join(self._chunks)
+        return value[max(0, len(value) - self.maxBytes):]
+
+
+def _pumpStream(streamName, stream, chunkSize, queue):
+    for chunk in iter(lambda: stream.readline(chunkSize), b''):
+        queue.put((streamName, chunk))
+    stream.close()
+    queue.put((streamName, None))
+
+
+def runCommandStreamOutput(
+        cmd, tailBytes=64 * 1024, chunkSize=64 * 1024, lineCallback=None):
+    """
+    Runs a shell command, yielding (streamName, line) tuples as the
+    command writes to its stdout and stderr, where streamName is
+    'stdout' or 'stderr'.  Lines longer than chunkSize are yielded in
+    chunkSize pieces.  If given, lineCallback(streamName, line) is called
+    for every line before it is yielded.  Only the last tailBytes bytes
+    of output are retained, to be reported in the CalledProcessError
+    raised if the command fails.
+    """
+    splits = shlex.split(cmd)
+    proc = subprocess.Popen(
+        splits, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # the queue is bounded so that a slow consumer stalls the reader
+    # threads (and so the command) instead of buffering its output
+    queue = Queue.Queue(maxsize=64)
+    for streamName, stream in (
+            ('stdout', proc.stdout), ('stderr', proc.stderr)):
+        thread = threading.Thread(
+            target=_pumpStream, args=(streamName, stream, chunkSize, queue))
+        thread.daemon = True
+        thread.start()
+    tail = _TailBuffer(tailBytes)
+    openStreams = 2
+    try:
+        while openStreams > 0:
+            streamName, line = queue.get()
+            if line is None:
+                openStreams -= 1
+                continue
+            tail.write(line)
+            if lineCallback is not None:
+                lineCallback(streamName, line)
+            yield streamName, line
+    finally:
+        if openStreams > 0:
+            # the consumer stopped early; stop the command and unblock
+            # the reader threads
+            proc.kill()
+            while openStreams > 0:
+                if queue.get()[1] is None:
+                    openStreams -= 1
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(
+            proc.returncode, splits, output=tail.getvalue())
+
+
 def runCommandSplits(splits, silent=False, shell=False):
     """
     Run a shell command given the command's parsed command line
@@ -98,6 +487,273 @@ def runCommandSplits(splits, silent=False, shell=False):
             raise
 
 
+class CommandHandle(object):
+    """
+    A command submitted to a CommandExecutor.  The command runs in the
+    background; result() waits for it and returns or raises exactly what
+    the equivalent synchronous call would have.
+    """
+    def __init__(self, splits, silent, shell, returnOutput, timeoutSeconds):
+        self.splits = splits
+        self._silent = silent
+        self._shell = shell
+        self._returnOutput = returnOutput
+        self._timeoutSeconds = timeoutSeconds
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._proc = None
+        self._cancelled = False
+        self._timedOut = False
+        self._result = None
+        self._exception = None
+
+    def cancel(self):
+        """
+        Cancels the command, killing it if it has already started.  A
+        command that has not started yet is done at once.
+        """
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._cancelled = True
+            if self._proc is None:
+                self._exception = CommandCancelledException()
+                self._done.set()
+            elif self._proc.returncode is None:
+                self._proc.kill()
+
+    def done(self):
+        """
+        Returns True if the command has finished or been cancelled
+        """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for the command to
+        finish and returns its result, raising TimeoutException if it
+        has not finished by then
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutException()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def _expire(self):
+        with self._lock:
+            self._timedOut = True
+            if self._proc.returncode is None:
+                self._proc.kill()
+
+    def _run(self):
+        if self._done.is_set():
+            # cancelled while queued
+            return
+        result = exception = None
+        try:
+            result = self._execute()
+        except Exception as caught:
+            exception = caught
+        finally:
+            with self._lock:
+                if not self._done.is_set():
+                    self._result = result
+                    self._exception = exception
+                    self._done.set()
+
+    def _execute(self):
+        stdout = stderr = None
+        if self._returnOutput:
+            stdout = stderr = subprocess.PIPE
+        elif self._silent:
+            stdout = stderr = open(os.devnull, 'w')
+        try:
+            with self._lock:
+                if self._cancelled:
+                    raise CommandCancelledException()
+                self._proc = subprocess.Popen(
+                    self.splits, stdout=stdout, stderr=stderr,
+                    shell=self._shell)
+        except OSError as exception:
+            if exception.errno == 2:  # cmd not found
+                raise Exception(
+                    "Can't find command while trying to run {}".format(
+                        self.splits))
+            raise
+        finally:
+            if self._silent and not self._returnOutput:
+                stdout.close()
+        timer = None
+        if self._timeoutSeconds is not None:
+            timer = threading.Timer(self._timeoutSeconds, self._expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            output = self._proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        with self._lock:
+            if self._cancelled:
+                raise CommandCancelledException()
+            if self._timedOut:
+                raise TimeoutException()
+        if self._proc.returncode != 0:
+            combinedOutput = None
+            if self._returnOutput:
+                combinedOutput = output[0] + output[1]
+            raise subprocess.CalledProcessError(
+                self._proc.returncode, self.splits, output=combinedOutput)
+        if self._returnOutput:
+            return output
+        return None
+
+
+class CommandExecutor(object):
+    """
+    Runs commands in the background without blocking the caller, with
+    at most maxConcurrent of them running at once.  The submit methods
+    mirror runCommand, runCommandSplits and runCommandReturnOutput, and
+    return a CommandHandle.  shutdown stops the worker threads; used as
+    a context manager, the executor is shut down on exit.
+    """
+    defaultMaxConcurrent = 8
+    _stop = object()
+
+    def __init__(self, maxConcurrent=defaultMaxConcurrent):
+        self.maxConcurrent = maxConcurrent
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.shutdown()
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads once the submitted commands have run,
+        waiting for them to finish if wait is set.  No more commands
+        may be submitted.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            workers = list(self._workers)
+        for _ in workers:
+            self._queue.put(self._stop)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def submitCommand(
+            self, command, silent=False, shell=False, timeoutSeconds=None):
+        return self.submitCommandSplits(
+            shlex.split(command), silent=silent, shell=shell,
+            timeoutSeconds=timeoutSeconds)
+
+    def submitCommandSplits(
+            self, splits, silent=False, shell=False, timeoutSeconds=None):
+        handle = CommandHandle(splits, silent, shell, False, timeoutSeconds)
+        self._submit(handle)
+        return handle
+
+    def submitCommandReturnOutput(self, cmd, timeoutSeconds=None):
+        handle = CommandHandle(
+            shlex.split(cmd), False, False, True, timeoutSeconds)
+        self._submit(handle)
+        return handle
+
+    def _submit(self, handle):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Can't submit to a shut down executor")
+            # workers are started on demand, up to maxConcurrent of them
+            if len(self._workers) < self.maxConcurrent:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+            # queued under the lock, so that no handle follows the
+            # shutdown sentinels
+            self._queue.put(handle)
+
+    def _work(self):
+        while True:
+            handle = self._queue.get()
+            if handle is self._stop:
+                return
+            handle._run()
+
+
+CommandResult = collections.namedtuple(
+    'CommandResult', ['command', 'returncode', 'seconds', 'output'])
+
+
+def _runCommandForResult(command, tailBytes, failedEvent):
+    if failedEvent.is_set():
+        return None
+    start = time.time()
+    tail = _TailBuffer(tailBytes)
+    try:
+        proc = subprocess.Popen(
+            shlex.split(command), stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    except OSError as exception:
+        if exception.errno != 2:  # cmd not found
+            raise
+        tail.write("Can't find command while trying to run {}".format(
+            command).encode('utf-8'))
+        returncode = 127
+    else:
+        for chunk in iter(lambda: proc.stdout.read(65536), b''):
+            tail.write(chunk)
+        proc.stdout.close()
+        returncode = proc.wait()
+    return CommandResult(
+        command, returncode, time.time() - start, tail.getvalue())
+
+
+def runCommands(
+        commands, maxWorkers=CommandExecutor.defaultMaxConcurrent,
+        failFast=False, tailBytes=4096):
+    """
+    Runs the commands concurrently, at most maxWorkers at a time, and
+    returns a list with a CommandResult for each of them in the same
+    order.  A CommandResult holds the command's exit code, its run time
+    in seconds, and the last tailBytes of its interleaved stdout and
+    stderr.  If any command fails, a CommandsFailedException listing
+    every failure is raised once the batch is finished.  With failFast,
+    no further commands are started after the first failure, and the
+    results of commands that never ran are None.
+    """
+    failedEvent = threading.Event()
+
+    def runOneCommand(command):
+        result = _runCommandForResult(command, tailBytes, failedEvent)
+        if failFast and result is not None and result.returncode != 0:
+            failedEvent.set()
+        return result
+
+    pool = multiprocessingPool.ThreadPool(maxWorkers)
+    try:
+        results = pool.map(runOneCommand, commands, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    failures = [
+        result for result in results
+        if result is not None and result.returncode != 0]
+    if len(failures) > 0:
+        raise CommandsFailedException(failures, results)
+    return results
+
+
 def getAuthValues(filePath='scripts/auth.yml'):
     """
     Return the script authentication file as a dictionary
@@ -105,34 +761,144 @@ def getAuthValues(filePath='scripts/auth.yml'):
     return getYamlDocument(filePath)
 
 
-def getYamlDocument(filePath):
+class _YamlDocumentCache(object):
     """
-    Return a yaml file's contents as a dictionary
+    A least recently used cache of parsed yaml documents, keyed by path
+    and validated against the file's inode, mtime and size
     """
-    with open(filePath) as stream:
-        doc = yaml.load(stream)
+    # as in FileIndex, a file modified this close to being read may
+    # change again within the same mtime tick, so it isn't cached
+    racyWindowSeconds = 2
+
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, filePath):
+        path = os.path.abspath(filePath)
+        # open (rather than stat) the file first, so a missing file
+        # raises IOError as it did before there was a cache
+        with open(path) as stream:
+            stat = os.fstat(stream.fileno())
+            key = (stat.st_ino, stat.st_mtime, stat.st_size)
+            with self._lock:
+                entry = self._entries.pop(path, None)
+                if entry is not None and entry[0] == key:
+                    self._entries[path] = entry
+                    return entry[1]
+            readTime = time.time()
+            doc = yaml.load(stream, Loader=_getYamlLoader())
+        if readTime - stat.st_mtime < self.racyWindowSeconds:
+            return doc
+        with self._lock:
+            self._entries[path] = (key, doc)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
         return doc
 
 
+_yamlDocumentCache = _YamlDocumentCache(maxEntries=64)
+
+
+def getYamlDocument(filePath, useCache=True):
+    """
+    Return a yaml file's contents as a dictionary.  Only standard yaml
+    tags are accepted.  Parsed documents are cached until the file
+    changes; every call returns a fresh copy that is safe to modify.
+    """
+    if not useCache:
+        with open(filePath) as stream:
+            return yaml.load(stream, Loader=_getYamlLoader())
+    return copy.deepcopy(_yamlDocumentCache.get(filePath))
+
+
+def iterYamlDocuments(filePath):
+    """
+    Yields the documents in a (possibly multi-document) yaml file one at
+    a time, so only one document is in memory at once
+    """
+    with open(filePath) as stream:
+        for doc in yaml.load_all(stream, Loader=_getYamlLoader()):
+            yield doc
+
+
+def iterYamlItems(filePath):
+    """
+    Yields the items of the top-level list of each document in a yaml
+    file one at a time, so only one item is in memory at once.  A
+    document that is not a list is yielded whole.
+    """
+    with open(filePath) as stream:
+        loader = _getYamlItemLoader()(stream)
+        try:
+            loader.get_event()  # StreamStartEvent
+            while not loader.check_event(yaml.StreamEndEvent):
+                loader.get_event()  # DocumentStartEvent
+                if loader.check_event(yaml.SequenceStartEvent):
+                    loader.get_event()
+                    while not loader.check_event(yaml.SequenceEndEvent):
+                        node = loader.compose_node(None, None)
+                        yield loader.construct_document(node)
+                    loader.get_event()
+                else:
+                    node = loader.compose_node(None, None)
+                    yield loader.construct_document(node)
+                loader.get_event()  # DocumentEndEvent
+                loader.anchors = {}
+        finally:
+            loader.dispose()
+
+
+class _Utf8Writer(object):
+    """
+    A file wrapper that encodes unicode writes as UTF-8, and passes
+    byte strings through unchanged
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, fileHandle):
+        self._fileHandle = fileHandle
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode(self.encoding)
+        self._fileHandle.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def __getattr__(self, name):
+        return getattr(self._fileHandle, name)
+
+
 def captureOutput(func, *args, **kwargs):
     """
     Runs the specified function and arguments, and returns the
-    tuple (stdout, stderr) as strings.
+    tuple (stdout, stderr) as unicode strings, decoded as UTF-8.  Output
+    is captured at the file descriptor level (see captureFdOutput), so
+    output written by C extensions and subprocesses is included.
     """
     stdout = sys.stdout
-    sys.stdout = StringIO.StringIO()
     stderr = sys.stderr
-    sys.stderr = StringIO.StringIO()
-    try:
-        func(*args, **kwargs)
-        stdoutOutput = sys.stdout.getvalue()
-        stderrOutput = sys.stderr.getvalue()
-    finally:
-        sys.stdout.close()
-        sys.stdout = stdout
-        sys.stderr.close()
-        sys.stderr = stderr
-    return stdoutOutput, stderrOutput
+    with captureFdOutput() as captured:
+        # route Python-level writes to the captured descriptors even if
+        # sys.stdout and sys.stderr have been replaced (e.g. by nose);
+        # they are unbuffered so that they keep their place among writes
+        # by subprocesses and C code
+        sys.stdout = _Utf8Writer(os.fdopen(os.dup(1), 'w', 0))
+        sys.stderr = _Utf8Writer(os.fdopen(os.dup(2), 'w', 0))
+        try:
+            func(*args, **kwargs)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            sys.stderr.close()
+            sys.stderr = stderr
+    return (
+        captured.stdout[:].decode('utf-8', 'replace'),
+        captured.stderr[:].decode('utf-8', 'replace'))
 
 
 def zipLists(*lists):
@@ -149,6 +915,30 @@ def zipLists(*lists):
     return zip(*lists)
 
 
+def zipIterators(*iterables):
+    """
+    Lazily zips the iterables, which need not have a length, and throws
+    an AssertionError as soon as one of them runs out before the others.
+    Nothing is buffered, so arbitrarily long streams can be zipped.
+    """
+    sentinel = object()
+    for position, values in enumerate(itertools.izip_longest(
+            *iterables, fillvalue=sentinel)):
+        exhausted = [value is sentinel for value in values]
+        if any(exhausted):
+            if exhausted[0]:
+                index = exhausted.index(False)
+                msg = ("Iterator at index {} has more than {} items, "
+                       "the length of iterator at index 0").format(
+                           index, position)
+            else:
+                index = exhausted.index(True)
+                msg = ("Iterator at index {} has length {} < length "
+                       "of iterator at index 0").format(index, position)
+            raise AssertionError(msg)
+        yield values
+
+
 def getLinesFromLogFile(stream):
     """
     Returns all lines written to the passed in stream
@@ -159,16 +949,274 @@ def getLinesFromLogFile(stream):
     return lines
 
 
-def powerset(iterable, maxSets=None):
+class LogFileTailer(object):
+    """
+    Incrementally reads the lines appended to the log file at path.
+    Each call of readLines returns only the lines completed since the
+    previous call; a trailing partial line is held back until its
+    newline is written.  If the file is truncated, reading restarts from
+    its beginning; if it is rotated (path names a new file), the rest of
+    the old file is read before switching to the new one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._inode = None
+        self._partial = b''
+        self._open()
+
+    def _open(self):
+        try:
+            # io files, unlike Python 2 files, don't stay at EOF once the
+            # end has been read
+            self._file = io.open(self.path, 'rb')
+        except IOError:
+            self._file = None
+            return
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._partial = b''
+
+    def _readAvailable(self):
+        data = self._file.read()
+        if not data:
+            return []
+        data = self._partial + data
+        end = data.rfind(b'\n') + 1
+        self._partial = data[end:]
+        if end == 0:
+            return []
+        return [line + b'\n' for line in data[:end - 1].split(b'\n')]
+
+    def readLines(self):
+        """
+        Returns the complete lines written since the last call
+        """
+        if self._file is None:
+            self._open()
+            if self._file is None:
+                return []
+        if os.fstat(self._file.fileno()).st_size < self._file.tell():
+            # truncated
+            self._file.seek(0)
+            self._partial = b''
+        lines = self._readAvailable()
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            inode = None
+        if inode is not None and inode != self._inode:
+            # rotated; the old file's partial line will never be finished
+            if self._partial:
+                lines.append(self._partial)
+            self._file.close()
+            self._open()
+            if self._file is not None:
+                lines.extend(self._readAvailable())
+        return lines
+
+    def waitForLines(self, timeoutSeconds=None, pollSeconds=0.1):
+        """
+        Returns the complete lines written since the last call, waiting
+        up to timeoutSeconds (forever if None) for at least one.  While
+        waiting, only the file's metadata is polled, every pollSeconds.
+        """
+        start = _wallClock()
+        while True:
+            lines = self.readLines()
+            if len(lines) > 0:
+                return lines
+            lastStat = self._statKey()
+            while self._statKey() == lastStat:
+                if (timeoutSeconds is not None and
+                        _wallClock() - start >= timeoutSeconds):
+                    return []
+                time.sleep(pollSeconds)
+
+    def _statKey(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def powerset(iterable, maxSets=None, minSize=0, maxSize=None):
     """
     powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)
 
+    Only subsets with between minSize and maxSize (by default, all)
+    elements are generated, and at most maxSets of them.
+
     See https://docs.python.org/2/library/itertools.html#recipes
     """
-    s = list(iterable)
-    return itertools.islice(itertools.chain.from_iterable(
-        itertools.combinations(s, r) for r in range(len(s) + 1)),
-        0, maxSets)
+    return iterSubsets(
+        list(iterable), 0, maxSets, minSize=minSize, maxSize=maxSize)
+
+
+def _binomial(n, k):
+    if k < 0 or k > n:
+        return 0
+    k = min(k, n - k)
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+def _getSubsetSizes(items, minSize, maxSize):
+    if maxSize is None or maxSize > len(items):
+        maxSize = len(items)
+    return range(max(minSize, 0), maxSize + 1)
+
+
+def countSubsets(items, minSize=0, maxSize=None):
+    """
+    Returns the number of subsets of items that powerset generates
+    """
+    return sum(
+        _binomial(len(items), size)
+        for size in _getSubsetSizes(items, minSize, maxSize))
+
+
+def _unrankCombination(n, size, index):
+    # the index-th combination of size positions out of n, in the order
+    # of itertools.combinations
+    positions = []
+    start = 0
+    for i in range(size):
+        for position in range(start, n):
+            count = _binomial(n - position - 1, size - i - 1)
+            if index < count:
+                positions.append(position)
+                start = position + 1
+                break
+            index -= count
+    return positions
+
+
+def _nextCombination(positions, n):
+    # advances positions to the next combination in place, returning
+    # False if it was the last one of its size
+    size = len(positions)
+    i = size - 1
+    while i >= 0 and positions[i] == n - size + i:
+        i -= 1
+    if i < 0:
+        return False
+    positions[i] += 1
+    for j in range(i + 1, size):
+        positions[j] = positions[j - 1] + 1
+    return True
+
+
+def getSubsetAtIndex(items, index, minSize=0, maxSize=None):
+    """
+    Returns the subset of items at index in the order that powerset
+    generates them, without generating the subsets before it
+    """
+    for size in _getSubsetSizes(items, minSize, maxSize):
+        count = _binomial(len(items), size)
+        if index < count:
+            positions = _unrankCombination(len(items), size, index)
+            return tuple(items[position] for position in positions)
+        index -= count
+    raise IndexError("subset index out of range")
+
+
+def getSubsetIndex(items, subset, minSize=0, maxSize=None):
+    """
+    Returns the index of subset (a tuple of items, in their order in
+    items) in the order that powerset generates the subsets of items
+    """
+    n = len(items)
+    size = len(subset)
+    if size not in _getSubsetSizes(items, minSize, maxSize):
+        raise ValueError("subset size out of range")
+    index = sum(
+        _binomial(n, smallerSize)
+        for smallerSize in _getSubsetSizes(items, minSize, size - 1))
+    previous = -1
+    for i, item in enumerate(subset):
+        position = items.index(item, previous + 1)
+        for skipped in range(previous + 1, position):
+            index += _binomial(n - skipped - 1, size - i - 1)
+        previous = position
+    return index
+
+
+def _iterCombinationsFrom(items, positions):
+    # the combinations of len(positions) items, in the order of
+    # itertools.combinations, starting at positions
+    while True:
+        yield tuple(items[position] for position in positions)
+        if not _nextCombination(positions, len(items)):
+            return
+
+
+def iterSubsets(items, start=0, stop=None, minSize=0, maxSize=None):
+    """
+    Returns an iterator over the subsets of items with indexes from
+    start up to (but not including) stop in the order that powerset
+    generates them, starting at start without generating the subsets
+    before it
+    """
+    n = len(items)
+    total = countSubsets(items, minSize, maxSize)
+    if stop is None or stop > total:
+        stop = total
+    if start >= stop:
+        return iter(())
+    sizes = list(_getSubsetSizes(items, minSize, maxSize))
+    index = start
+    for i, size in enumerate(sizes):
+        count = _binomial(n, size)
+        if index < count:
+            break
+        index -= count
+    # only the first size may start part way through; whole sizes are
+    # left to the much faster itertools.combinations
+    if index == 0:
+        first = itertools.combinations(items, size)
+    else:
+        first = _iterCombinationsFrom(
+            items, _unrankCombination(n, size, index))
+    rest = itertools.chain.from_iterable(
+        itertools.combinations(items, size) for size in sizes[i + 1:])
+    return itertools.islice(
+        itertools.chain(first, rest), stop - start)
+
+
+def sampleSubsets(items, count, minSize=0, maxSize=None, rng=None):
+    """
+    Returns count subsets of items drawn uniformly at random (with
+    replacement) from those that powerset generates, using the random
+    number generator rng (by default, the random module)
+    """
+    if rng is None:
+        rng = random
+    total = countSubsets(items, minSize, maxSize)
+    return [
+        getSubsetAtIndex(
+            items, rng.randrange(total), minSize=minSize, maxSize=maxSize)
+        for _ in range(count)]
+
+
+def shardSubsets(items, shardIndex, numShards, minSize=0, maxSize=None):
+    """
+    Yields the shardIndex-th of numShards contiguous, near-equal shares
+    of the subsets that powerset generates, so that the enumeration can
+    be split between numShards workers
+    """
+    total = countSubsets(items, minSize, maxSize)
+    start = total * shardIndex // numShards
+    stop = total * (shardIndex + 1) // numShards
+    return iterSubsets(
+        items, start, stop, minSize=minSize, maxSize=maxSize)
 
 
 def chomp(line):
@@ -179,22 +1227,317 @@ def chomp(line):
     return line[:-1]
 
 
-def getFilePathsWithExtensionsInDirectory(dirTree, patterns, sort=True):
+def _iterFileChunks(filePath, chunkSize, useMmap):
+    if _isGzipped(filePath):
+        with gzip.open(filePath, 'rb') as fileHandle:
+            for chunk in _iterBlocks(fileHandle, chunkSize):
+                yield chunk
+    elif useMmap:
+        with open(filePath, 'rb') as fileHandle:
+            size = os.fstat(fileHandle.fileno()).st_size
+            if size == 0:
+                return
+            fileMap = mmap.mmap(
+                fileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in range(0, size, chunkSize):
+                    yield fileMap[offset:offset + chunkSize]
+            finally:
+                fileMap.close()
+    else:
+        with open(filePath, 'rb') as fileHandle:
+            for chunk in _iterBlocks(fileHandle, chunkSize):
+                yield chunk
+
+
+def _stripCarriageReturns(lines):
+    return [line[:-1] if line.endswith(b'\r') else line for line in lines]
+
+
+def iterChompedLineBatches(
+        filePath, chunkSize=1024 * 1024, useMmap=False,
+        allowMissingFinalNewline=True):
+    """
+    Yields lists of the lines of the file, with their trailing newline
+    (or CRLF) removed as chomp does, reading the file in chunkSize
+    blocks (memory mapped if useMmap) and splitting each block in one
+    go.  Gzip and bgzip compressed files are decompressed.  The last
+    line is yielded even if it has no trailing newline, unless
+    allowMissingFinalNewline is false, in which case an AssertionError
+    is thrown.
+    """
+    partial = b''
+    for chunk in _iterFileChunks(filePath, chunkSize, useMmap):
+        data = partial + chunk
+        lines = data.split(b'\n')
+        partial = lines.pop()
+        if len(lines) == 0:
+            continue
+        if b'\r' in data:
+            lines = _stripCarriageReturns(lines)
+        yield lines
+    if partial:
+        assert allowMissingFinalNewline, "Missing final newline"
+        yield _stripCarriageReturns([partial])
+
+
+def iterChompedLines(
+        filePath, chunkSize=1024 * 1024, useMmap=False,
+        allowMissingFinalNewline=True):
+    """
+    Yields the lines of the file one at a time, with their trailing
+    newline removed.  See iterChompedLineBatches, which is faster still,
+    for the arguments.
+    """
+    for lines in iterChompedLineBatches(
+            filePath, chunkSize, useMmap, allowMissingFinalNewline):
+        for line in lines:
+            yield line
+
+
+def _compilePatterns(patterns):
+    """
+    Compiles the glob patterns into one regular expression matching a
+    name that matches any of them
+    """
+    return re.compile('|'.join(
+        '(?:{})'.format(fnmatch.translate(pattern)) for pattern in patterns))
+
+
+def _scanDirectory(directory):
+    """
+    Returns the tuple (fileNames, dirNames) for the entries of the
+    directory.  As in os.walk, symbolic links to directories are
+    neither files nor directories to descend into.
+    """
+    fileNames = []
+    dirNames = []
+    if _scandir is not None:
+        for entry in _scandir(directory):
+            if not entry.is_dir():
+                fileNames.append(entry.name)
+            elif not entry.is_symlink():
+                dirNames.append(entry.name)
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not os.path.isdir(path):
+                fileNames.append(name)
+            elif not os.path.islink(path):
+                dirNames.append(name)
+    return fileNames, dirNames
+
+
+def _getOrderedEntries(directory, excludeMatcher, sort):
+    """
+    Returns the (name, isDir) entries to visit in the directory.  When
+    sorting, a directory's name sorts as if followed by a path
+    separator, so that visiting the entries depth first in this order
+    yields full paths in sorted order.
+    """
+    try:
+        fileNames, dirNames = _scanDirectory(directory)
+    except OSError:
+        # like os.walk, skip directories that can't be listed
+        return []
+    if excludeMatcher is not None:
+        dirNames = [
+            name for name in dirNames if not excludeMatcher.match(name)]
+    entries = [(name, False) for name in fileNames]
+    entries.extend((name, True) for name in dirNames)
+    if sort:
+        entries.sort(key=lambda entry: entry[0] + os.sep * entry[1])
+    return entries
+
+
+def _iterMatchingPaths(directory, matcher, excludeMatcher, sort):
+    for name, isDir in _getOrderedEntries(directory, excludeMatcher, sort):
+        path = os.path.join(directory, name)
+        if isDir:
+            for subPath in _iterMatchingPaths(
+                    path, matcher, excludeMatcher, sort):
+                yield subPath
+        elif matcher.match(name):
+            yield path
+
+
+def iterFilePathsWithExtensionsInDirectory(
+        dirTree, patterns, sort=False, excludeDirs=None, numThreads=1):
+    """
+    Yields the file paths that match any one of patterns in a file tree
+    with its root at dirTree, as they are found.  Directories whose name
+    matches any one of the excludeDirs patterns are not descended into.
+    If sort is set, the paths are yielded in sorted order without being
+    collected first.  If numThreads is more than one, the subtrees of
+    dirTree are walked in parallel by that many threads.
+    """
+    matcher = _compilePatterns(patterns)
+    excludeMatcher = None
+    if excludeDirs:
+        excludeMatcher = _compilePatterns(excludeDirs)
+    if numThreads <= 1:
+        for path in _iterMatchingPaths(
+                dirTree, matcher, excludeMatcher, sort):
+            yield path
+        return
+    entries = _getOrderedEntries(dirTree, excludeMatcher, sort)
+
+    def walkSubtree(subtree):
+        return list(_iterMatchingPaths(
+            subtree, matcher, excludeMatcher, sort))
+
+    pool = multiprocessingPool.ThreadPool(numThreads)
+    try:
+        # imap preserves the order of the subtrees, so their paths can
+        # be merged back in as each one is reached
+        subtreePaths = pool.imap(walkSubtree, [
+            os.path.join(dirTree, name) for name, isDir in entries if isDir])
+        for name, isDir in entries:
+            if isDir:
+                for path in next(subtreePaths):
+                    yield path
+            elif matcher.match(name):
+                yield os.path.join(dirTree, name)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def getFilePathsWithExtensionsInDirectory(
+        dirTree, patterns, sort=True, excludeDirs=None, numThreads=1):
     """
     Returns all file paths that match any one of patterns in a
     file tree with its root at dirTree.  Sorts the paths by default.
+    See iterFilePathsWithExtensionsInDirectory for the other arguments.
     """
-    filePaths = []
-    for root, dirs, files in os.walk(dirTree):
-        for filePath in files:
-            for pattern in patterns:
-                if fnmatch.fnmatch(filePath, pattern):
-                    fullPath = os.path.join(root, filePath)
-                    filePaths.append(fullPath)
-                    break
-    if sort:
-        filePaths.sort()
-    return filePaths
+    return list(iterFilePathsWithExtensionsInDirectory(
+        dirTree, patterns, sort=sort, excludeDirs=excludeDirs,
+        numThreads=numThreads))
+
+
+FileIndexScan = collections.namedtuple(
+    'FileIndexScan', ['filePaths', 'addedFilePaths', 'removedFilePaths'])
+
+
+class FileIndex(object):
+    """
+    A persistent index, stored in an sqlite database at indexPath, of
+    the file paths that match any one of patterns in a file tree with
+    its root at dirTree.  The index remembers every directory's mtime,
+    so a rescan only lists the directories that have changed since the
+    last scan.
+    """
+    # a directory modified this close to a scan may change again within
+    # the same mtime tick, so its mtime isn't trusted on the next scan
+    racyWindowSeconds = 2
+    _schema = """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS directories (
+            path TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, directory TEXT);
+        CREATE INDEX IF NOT EXISTS filesByDirectory ON files (directory);
+    """
+
+    def __init__(self, indexPath, dirTree, patterns, excludeDirs=None):
+        self.dirTree = dirTree
+        self._matcher = _compilePatterns(patterns)
+        self._excludeMatcher = None
+        if excludeDirs:
+            self._excludeMatcher = _compilePatterns(excludeDirs)
+        self._connection = sqlite3.connect(indexPath)
+        settings = json.dumps([dirTree, patterns, excludeDirs])
+        with self._connection:
+            self._connection.executescript(self._schema)
+            row = self._connection.execute(
+                "SELECT value FROM settings WHERE key = 'settings'"
+            ).fetchone()
+            if row is None or row[0] != settings:
+                # the index was built for a different scan, so start over
+                self._connection.execute("DELETE FROM directories")
+                self._connection.execute("DELETE FROM files")
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO settings VALUES ('settings', ?)",
+                    (settings,))
+
+    def close(self):
+        self._connection.close()
+
+    def scan(self):
+        """
+        Brings the index up to date with the file tree, and returns a
+        FileIndexScan holding all of the sorted matching file paths and
+        those that were added and removed since the last scan
+        """
+        scanTime = time.time()
+        knownMtimes = {}
+        knownSubdirs = collections.defaultdict(list)
+        for path, parent, mtime in self._connection.execute(
+                "SELECT path, parent, mtime FROM directories"):
+            knownMtimes[path] = mtime
+            knownSubdirs[parent].append(path)
+        addedFilePaths = []
+        removedFilePaths = []
+        seenDirs = set()
+        pending = [(self.dirTree, None)]
+        with self._connection:
+            while len(pending) > 0:
+                directory, parent = pending.pop()
+                try:
+                    mtime = os.stat(directory).st_mtime
+                except OSError:
+                    continue
+                seenDirs.add(directory)
+                if knownMtimes.get(directory) == mtime:
+                    subdirs = knownSubdirs[directory]
+                else:
+                    subdirs = self._rescanDirectory(
+                        directory, parent, mtime, scanTime,
+                        addedFilePaths, removedFilePaths)
+                pending.extend((subdir, directory) for subdir in subdirs)
+            for directory in set(knownMtimes) - seenDirs:
+                self._removeDirectory(directory, removedFilePaths)
+        filePaths = [row[0] for row in self._connection.execute(
+            "SELECT path FROM files ORDER BY path")]
+        return FileIndexScan(
+            filePaths, sorted(addedFilePaths), sorted(removedFilePaths))
+
+    def _rescanDirectory(
+            self, directory, parent, mtime, scanTime, addedFilePaths,
+            removedFilePaths):
+        entries = _getOrderedEntries(directory, self._excludeMatcher, False)
+        filePaths = set(
+            os.path.join(directory, name) for name, isDir in entries
+            if not isDir and self._matcher.match(name))
+        knownFilePaths = set(row[0] for row in self._connection.execute(
+            "SELECT path FROM files WHERE directory = ?", (directory,)))
+        added = filePaths - knownFilePaths
+        removed = knownFilePaths - filePaths
+        self._connection.executemany(
+            "INSERT INTO files VALUES (?, ?)",
+            ((path, directory) for path in added))
+        self._connection.executemany(
+            "DELETE FROM files WHERE path = ?",
+            ((path,) for path in removed))
+        addedFilePaths.extend(added)
+        removedFilePaths.extend(removed)
+        if scanTime - mtime < self.racyWindowSeconds:
+            mtime = None
+        self._connection.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)",
+            (directory, parent, mtime))
+        return [
+            os.path.join(directory, name) for name, isDir in entries
+            if isDir]
+
+    def _removeDirectory(self, directory, removedFilePaths):
+        removedFilePaths.extend(row[0] for row in self._connection.execute(
+            "SELECT path FROM files WHERE directory = ?", (directory,)))
+        self._connection.execute(
+            "DELETE FROM files WHERE directory = ?", (directory,))
+        self._connection.execute(
+            "DELETE FROM directories WHERE path = ?", (directory,))
 
 
 def touch(filepath):
@@ -205,9 +1548,46 @@ def touch(filepath):
         pass
 
 
-def assertFileContentsIdentical(pathOne, pathTwo):
-    with open(pathOne) as fileOne, open(pathTwo) as fileTwo:
-        for i, (lineOne, lineTwo) in enumerate(zip(fileOne, fileTwo)):
+_gzipMagic = b'\x1f\x8b'
+
+
+def _isGzipped(path):
+    with open(path, 'rb') as fileHandle:
+        return fileHandle.read(len(_gzipMagic)) == _gzipMagic
+
+
+def _openMaybeCompressed(path):
+    """
+    Opens path for binary reading, transparently decompressing it if it
+    is gzip (or bgzip) compressed
+    """
+    if _isGzipped(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _iterBlocks(fileHandle, blockSize):
+    return iter(lambda: fileHandle.read(blockSize), b'')
+
+
+def _blocksIdentical(pathOne, pathTwo, blockSize):
+    with _openMaybeCompressed(pathOne) as fileOne, \
+            _openMaybeCompressed(pathTwo) as fileTwo:
+        for blockOne, blockTwo in itertools.izip_longest(
+                _iterBlocks(fileOne, blockSize),
+                _iterBlocks(fileTwo, blockSize)):
+            if blockOne != blockTwo:
+                # file objects return full blocks until the end of the
+                # file, so the blocks stay aligned
+                return False
+    return True
+
+
+def _assertFileLinesIdentical(pathOne, pathTwo):
+    with _openMaybeCompressed(pathOne) as fileOne, \
+            _openMaybeCompressed(pathTwo) as fileTwo:
+        for i, (lineOne, lineTwo) in enumerate(
+                itertools.izip(fileOne, fileTwo)):
             if lineOne != lineTwo:
                 msg = "Mismatch on line {}: '{}' != '{}'".format(
                     i + 1, lineOne, lineTwo)
@@ -223,6 +1603,47 @@ def assertFileContentsIdentical(pathOne, pathTwo):
             raise AssertionError(msg)
 
 
+def assertFileContentsIdentical(pathOne, pathTwo, blockSize=1024 * 1024):
+    """
+    Checks that the two files have the same contents, and throws an
+    AssertionError reporting the first mismatching line otherwise.
+    Gzip and bgzip compressed files are compared by their decompressed
+    contents.
+    """
+    compressed = _isGzipped(pathOne) or _isGzipped(pathTwo)
+    # uncompressed files of different sizes can't be identical, so
+    # skip straight to finding the mismatch
+    if (compressed or
+            os.path.getsize(pathOne) == os.path.getsize(pathTwo)):
+        if _blocksIdentical(pathOne, pathTwo, blockSize):
+            return
+    # the files differ; compare them line by line to report where
+    _assertFileLinesIdentical(pathOne, pathTwo)
+
+
+def getFileDigest(path, algorithm='sha256', blockSize=1024 * 1024):
+    """
+    Returns the hex digest of the file's contents, decompressing them
+    first if the file is gzip (or bgzip) compressed
+    """
+    digest = hashlib.new(algorithm)
+    with _openMaybeCompressed(path) as fileHandle:
+        for block in _iterBlocks(fileHandle, blockSize):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def assertFileDigest(path, expectedDigest, algorithm='sha256'):
+    """
+    Checks that the file's contents have the expected hex digest, and
+    throws an AssertionError otherwise
+    """
+    digest = getFileDigest(path, algorithm)
+    if digest != expectedDigest:
+        msg = "Digest of {} is {} != {}".format(path, digest, expectedDigest)
+        raise AssertionError(msg)
+
+
 # ---------------- Decorators ----------------
 
 
@@ -232,24 +1653,586 @@ class TimeoutException(Exception):
     """
 
 
+class CommandCancelledException(Exception):
+    """
+    A command was cancelled before it finished
+    """
+
+
+class CommandsFailedException(Exception):
+    """
+    One or more of a batch of commands exited with a nonzero status
+    """
+    def __init__(self, failures, results):
+        self.failures = failures
+        self.results = results
+        lines = ["{} of {} commands failed:".format(
+            len(failures), len(results))]
+        for failure in failures:
+            lines.append("  exit status {}: {}".format(
+                failure.returncode, failure.command))
+        super(CommandsFailedException, self).__init__("\n".join(lines))
+
+
+# the clock_gettime clock ids of CLOCK_MONOTONIC, by sys.platform prefix
+_monotonicClockIds = {'linux': 1, 'darwin': 6}
+
+
+def _createMonotonicClock():
+    """
+    Returns a function returning seconds from CLOCK_MONOTONIC, read with
+    clock_gettime through ctypes since Python 2 has no monotonic clock,
+    or time.time where clock_gettime isn't available
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    clockIds = [
+        clockId for prefix, clockId in _monotonicClockIds.items()
+        if sys.platform.startswith(prefix)]
+    if len(clockIds) == 0:
+        return time.time
+    try:
+        # a PyDLL function holds the GIL while it runs, so one buffer can
+        # be shared by every thread: a call always fills it completely,
+        # and at worst a thread reads another's slightly later reading
+        clockGettime = ctypes.PyDLL(None).clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clockId = clockIds[0]
+    timespec = (ctypes.c_long * 2)()
+    timespecRef = ctypes.byref(timespec)
+
+    def monotonicClock():
+        if clockGettime(clockId, timespecRef) != 0:
+            raise OSError("clock_gettime failed")
+        seconds, nanoseconds = timespec[:]
+        return seconds + nanoseconds * 1e-9
+    return monotonicClock
+
+
+def _wallClock():
+    """
+    Returns the seconds from a monotonic clock, so that timings,
+    deadlines and expiry times are unaffected by changes to the system
+    time.  Falls back to time.time, which is not monotonic, on platforms
+    without clock_gettime.
+    """
+    # the clock is looked up on first use, to keep ctypes out of import
+    global _wallClock
+    _wallClock = _createMonotonicClock()
+    return _wallClock()
+
+
+_cpuClock = getattr(time, 'process_time', time.clock)
+
+
+class _TimingStats(object):
+    """
+    The call count, latency histogram and recent latencies of one
+    function
+    """
+    # upper bounds, in seconds, of the latency histogram buckets
+    bucketBounds = (
+        0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+    # percentiles are computed over this many of the most recent calls
+    recentSize = 1024
+
+    def __init__(self):
+        self.count = 0
+        self.totalSeconds = 0
+        self.totalCpuSeconds = 0
+        self.minSeconds = None
+        self.maxSeconds = None
+        self.bucketCounts = [0] * len(self.bucketBounds)
+        self.recentSeconds = collections.deque(maxlen=self.recentSize)
+
+    def record(self, seconds, cpuSeconds):
+        self.count += 1
+        self.totalSeconds += seconds
+        self.totalCpuSeconds += cpuSeconds
+        if self.minSeconds is None or seconds < self.minSeconds:
+            self.minSeconds = seconds
+        if self.maxSeconds is None or seconds > self.maxSeconds:
+            self.maxSeconds = seconds
+        for i, bound in enumerate(self.bucketBounds):
+            if seconds <= bound:
+                self.bucketCounts[i] += 1
+                break
+        self.recentSeconds.append(seconds)
+
+    def percentile(self, percent):
+        if len(self.recentSeconds) == 0:
+            return None
+        ordered = sorted(self.recentSeconds)
+        index = int(round(percent / 100 * (len(ordered) - 1)))
+        return ordered[index]
+
+    def toDict(self):
+        return {
+            'count': self.count,
+            'totalSeconds': self.totalSeconds,
+            'totalCpuSeconds': self.totalCpuSeconds,
+            'minSeconds': self.minSeconds,
+            'maxSeconds': self.maxSeconds,
+            'p50Seconds': self.percentile(50),
+            'p90Seconds': self.percentile(90),
+            'p99Seconds': self.percentile(99),
+        }
+
+
+def _escapePrometheusLabel(value):
+    return value.replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class TimingRegistry(object):
+    """
+    A thread-safe registry of timing statistics and event counters,
+    keyed by function name
+    """
+    prometheusPrefix = 'ga4gh'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._counters = {}
+
+    def record(self, name, seconds, cpuSeconds=0):
+        """
+        Records one call of the named function
+        """
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = _TimingStats()
+            stats.record(seconds, cpuSeconds)
+
+    def getStats(self, name):
+        """
+        Returns a dictionary of the named function's statistics, or None
+        if it has not been called
+        """
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                return None
+            return stats.toDict()
+
+    def incrementCounter(self, name, event, amount=1):
+        """
+        Counts amount occurrences of the event for the named function
+        """
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[event] = counters.get(event, 0) + amount
+
+    def getCounters(self, name):
+        """
+        Returns a dictionary of the named function's event counts, or
+        None if no events have been counted
+        """
+        with self._lock:
+            counters = self._counters.get(name)
+            if counters is None:
+                return None
+            return dict(counters)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._counters = {}
+
+    def toJson(self):
+        """
+        Returns the statistics of every function as a JSON object.  Any
+        event counts are under the 'counters' key of their function.
+        """
+        with self._lock:
+            document = dict(
+                (name, stats.toDict()) for name, stats in self._stats.items())
+            for name, counters in self._counters.items():
+                document.setdefault(name, {})['counters'] = dict(counters)
+            return json.dumps(document, sort_keys=True)
+
+    def toPrometheus(self):
+        """
+        Returns the statistics of every function in the Prometheus text
+        exposition format
+        """
+        secondsMetric = '{}_function_seconds'.format(self.prometheusPrefix)
+        cpuMetric = '{}_function_cpu_seconds_total'.format(
+            self.prometheusPrefix)
+        lines = [
+            '# HELP {} Wall clock time spent in the function'.format(
+                secondsMetric),
+            '# TYPE {} histogram'.format(secondsMetric)]
+        cpuLines = [
+            '# HELP {} CPU time spent in the function'.format(cpuMetric),
+            '# TYPE {} counter'.format(cpuMetric)]
+        eventsMetric = '{}_events_total'.format(self.prometheusPrefix)
+        eventLines = [
+            '# HELP {} Events counted for the function'.format(eventsMetric),
+            '# TYPE {} counter'.format(eventsMetric)]
+        with self._lock:
+            for name in sorted(self._stats):
+                stats = self._stats[name]
+                label = 'function="{}"'.format(_escapePrometheusLabel(name))
+                cumulativeCount = 0
+                for bound, count in zip(
+                        stats.bucketBounds, stats.bucketCounts):
+                    cumulativeCount += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        secondsMetric, label, bound, cumulativeCount))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                    secondsMetric, label, stats.count))
+                lines.append('{}_sum{{{}}} {!r}'.format(
+                    secondsMetric, label, stats.totalSeconds))
+                lines.append('{}_count{{{}}} {}'.format(
+                    secondsMetric, label, stats.count))
+                cpuLines.append('{}{{{}}} {!r}'.format(
+                    cpuMetric, label, stats.totalCpuSeconds))
+            for name in sorted(self._counters):
+                counters = self._counters[name]
+                for event in sorted(counters):
+                    eventLines.append(
+                        '{}{{function="{}",event="{}"}} {}'.format(
+                            eventsMetric, _escapePrometheusLabel(name),
+                            _escapePrometheusLabel(event), counters[event]))
+        return '\n'.join(lines + cpuLines + eventLines) + '\n'
+
+
+timingRegistry = TimingRegistry()
+
+
+def _checkSampleEvery(sampleEvery):
+    if sampleEvery is not None and sampleEvery < 1:
+        raise ValueError(
+            "sampleEvery must be at least 1, not {}".format(sampleEvery))
+
+
 class Timed(object):
     """
-    Decorator that times a method, reporting runtime at finish
+    Decorator that times a method, reporting runtime at finish.
+    Every call's wall clock and CPU time is also recorded in registry
+    (by default, the process-wide timingRegistry) under name (by
+    default, the function's qualified name).
+
+    With trace set, the decorator is instead switched on and off for
+    the whole process by enableTracing and disableTracing.  While
+    tracing is disabled, a call costs a single global lookup on top of
+    the call itself.  While it is enabled, one in every sampleEvery
+    calls (by default, the rate given to enableTracing) writes a trace
+    record with the function's name, start time, wall clock time, CPU
+    time and thread.
     """
+    def __init__(
+            self, report=True, registry=None, name=None, trace=False,
+            sampleEvery=None):
+        _checkSampleEvery(sampleEvery)
+        self.report = report
+        self.registry = registry
+        if self.registry is None:
+            self.registry = timingRegistry
+        self.name = name
+        self.trace = trace
+        self.sampleEvery = sampleEvery
+
     def __call__(self, func):
+        name = self.name
+        if name is None:
+            name = '{}.{}'.format(func.__module__, func.__name__)
+        if self.trace:
+            return self._wrapTraced(func, name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # timings are kept in locals so that concurrent and
+            # recursive calls don't interfere with each other
+            start = _wallClock()
+            cpuStart = _cpuClock()
+            result = func(*args, **kwargs)
+            delta = _wallClock() - start
+            self.registry.record(name, delta, _cpuClock() - cpuStart)
+            if self.report:
+                self._report(delta)
+            return result
+        return wrapper
+
+    def _wrapTraced(self, func, name):
+        # next() on an itertools.count is atomic, so the count is
+        # thread-safe without a lock
+        callCounter = itertools.count()
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            self.start = time.time()
+            writer = _traceWriter
+            if writer is None:
+                return func(*args, **kwargs)
+            sampleEvery = self.sampleEvery or _traceSampleEvery
+            if next(callCounter) % sampleEvery != 0:
+                return func(*args, **kwargs)
+            startTime = time.time()
+            start = _wallClock()
+            cpuStart = _cpuClock()
             result = func(*args, **kwargs)
-            self.end = time.time()
-            self._report()
+            writer.write({
+                'name': name,
+                'start': startTime,
+                'seconds': _wallClock() - start,
+                'cpuSeconds': _cpuClock() - cpuStart,
+                'thread': threading.current_thread().ident,
+            })
             return result
         return wrapper
 
-    def _report(self):
-        delta = self.end - self.start
+    def _report(self, delta):
+        if not _logger.isEnabledFor(logging.INFO):
+            return
         timeString = humanize.time.naturaldelta(delta)
-        log("Finished in {} ({:.2f} seconds)".format(timeString, delta))
+        log("Finished in {} ({:.2f} seconds)", timeString, delta)
+
+
+class TraceWriter(object):
+    """
+    Writes trace records to a file as JSON lines from a background
+    thread, so that tracing never waits on disk.  If the writer falls
+    behind by more than maxPending records, new records are dropped
+    (and counted) rather than blocking the traced code.
+    """
+    defaultMaxPending = 65536
+    _stop = object()
+
+    def __init__(self, filePath, maxPending=defaultMaxPending):
+        self.filePath = filePath
+        self.droppedRecords = 0
+        self._queue = Queue.Queue(maxsize=maxPending)
+        self._file = open(filePath, 'a', 64 * 1024)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.droppedRecords += 1
+
+    def close(self):
+        """
+        Writes out all pending records and closes the file
+        """
+        self._queue.put(self._stop)
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is self._stop:
+                break
+            self._file.write(json.dumps(record) + '\n')
+            if self._queue.empty():
+                self._file.flush()
+
+
+_traceWriter = None
+_traceSampleEvery = 1
+
+
+def enableTracing(filePath, sampleEvery=1):
+    """
+    Starts writing trace records for calls of traced functions (see
+    Timed) to filePath, sampling one in every sampleEvery calls of each
+    function
+    """
+    global _traceWriter, _traceSampleEvery
+    _checkSampleEvery(sampleEvery)
+    disableTracing()
+    _traceSampleEvery = sampleEvery
+    _traceWriter = TraceWriter(filePath)
+
+
+def disableTracing():
+    """
+    Stops tracing, writing out any pending trace records
+    """
+    global _traceWriter
+    writer = _traceWriter
+    _traceWriter = None
+    if writer is not None:
+        writer.close()
+
+
+class Traced(Timed):
+    """
+    Decorator that traces a method; shorthand for Timed(trace=True)
+    """
+    def __init__(self, name=None, sampleEvery=None):
+        super(Traced, self).__init__(
+            report=False, name=name, trace=True, sampleEvery=sampleEvery)
+
+
+class _MemoizedCall(object):
+    """
+    A computation of a memoized function that other callers with the
+    same arguments can wait for
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.succeeded = False
+        self.value = None
+        self.exception = None
+
+
+class _MemoizedCache(object):
+    """
+    The results cache of one memoized function
+    """
+    def __init__(self, maxSize, ttlSeconds, maxBytes, registry, name):
+        self.maxSize = maxSize
+        self.ttlSeconds = ttlSeconds
+        self.maxBytes = maxBytes
+        self._registry = registry
+        self._name = name
+        self._lock = threading.Lock()
+        # maps a key to its (value, expiry time, size in bytes)
+        self._entries = collections.OrderedDict()
+        self._calls = {}
+        self._bytes = 0
+        self._counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _count(self, event):
+        # called with the lock held
+        self._counts[event] += 1
+        self._registry.incrementCounter(self._name, event)
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        self._count('evictions')
+
+    def get(self, key, compute):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[1] is None or entry[1] > _wallClock():
+                    # reinsert to mark the entry as most recently used
+                    self._entries[key] = entry
+                    self._count('hits')
+                    return entry[0]
+                self._bytes -= entry[2]
+                self._count('evictions')
+            call = self._calls.get(key)
+            computing = call is None
+            if computing:
+                call = self._calls[key] = _MemoizedCall()
+                self._count('misses')
+            else:
+                self._count('hits')
+        if not computing:
+            # another thread is already computing this result
+            call.done.wait()
+            if call.succeeded:
+                return call.value
+            if call.exception is not None:
+                raise call.exception
+            # the computing thread was interrupted (e.g. by
+            # KeyboardInterrupt), which is no reason to fail this call
+            return self.get(key, compute)
+        try:
+            call.value = compute()
+            call.succeeded = True
+        except Exception as exception:
+            call.exception = exception
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.succeeded:
+                    self._store(key, call.value)
+            call.done.set()
+        return call.value
+
+    def _store(self, key, value):
+        # called with the lock held
+        expiry = None
+        if self.ttlSeconds is not None:
+            expiry = _wallClock() + self.ttlSeconds
+        size = 0
+        if self.maxBytes is not None:
+            size = sys.getsizeof(value)
+        self._entries[key] = (value, expiry, size)
+        self._bytes += size
+        while len(self._entries) > 0 and (
+                (self.maxSize is not None and
+                 len(self._entries) > self.maxSize) or
+                (self.maxBytes is not None and self._bytes > self.maxBytes)):
+            self._remove(next(iter(self._entries)))
+
+    def getInfo(self):
+        with self._lock:
+            info = dict(self._counts)
+            info['size'] = len(self._entries)
+            info['bytes'] = self._bytes
+            return info
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+# separates positional from keyword arguments in a Memoized cache key
+_kwargsMarker = object()
+
+
+class Memoized(object):
+    """
+    Decorator that caches a function's results by its arguments.  At
+    most maxSize results are kept, evicting the least recently used
+    first; results expire after ttlSeconds; and if maxBytes is given,
+    the results' (shallow, sys.getsizeof) sizes are kept under it.
+    Concurrent calls with the same arguments compute the result only
+    once.  Hits, misses and evictions are counted in registry (by
+    default, the process-wide timingRegistry) under name (by default,
+    the function's qualified name), and are returned by the decorated
+    function's cacheInfo().  Calls with unhashable arguments are not
+    cached.
+    """
+    defaultMaxSize = 128
+
+    def __init__(
+            self, maxSize=defaultMaxSize, ttlSeconds=None, maxBytes=None,
+            registry=None, name=None):
+        self.maxSize = maxSize
+        self.ttlSeconds = ttlSeconds
+        self.maxBytes = maxBytes
+        self.registry = registry
+        if self.registry is None:
+            self.registry = timingRegistry
+        self.name = name
+
+    def __call__(self, func):
+        name = self.name
+        if name is None:
+            name = '{}.{}'.format(func.__module__, func.__name__)
+        cache = _MemoizedCache(
+            self.maxSize, self.ttlSeconds, self.maxBytes, self.registry,
+            name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = args
+            if kwargs:
+                key += (_kwargsMarker,) + tuple(sorted(kwargs.items()))
+            try:
+                hash(key)
+            except TypeError:
+                return func(*args, **kwargs)
+            return cache.get(key, lambda: func(*args, **kwargs))
+        wrapper.cacheInfo = cache.getInfo
+        wrapper.cacheClear = cache.clear
+        return wrapper
 
 
 class Repeat(object):
@@ -257,24 +2240,83 @@ class Repeat(object):
     A decorator to use for repeating a tagged function.
     The tagged function should return true if it wants to run again,
     and false if it wants to stop repeating.
+
+    The sleep between runs starts at sleepSeconds and is multiplied by
+    backoffFactor after every run, up to maxSleepSeconds.  Each sleep is
+    randomly lengthened or shortened by up to the jitter fraction of
+    itself.  If the function still wants to run again after
+    deadlineSeconds or maxAttempts runs, TimeoutException is raised.
+    Setting wakeEvent (a threading.Event) ends the current sleep early.
     """
     defaultSleepSeconds = 0.1
 
-    def __init__(self, sleepSeconds=defaultSleepSeconds):
+    def __init__(
+            self, sleepSeconds=defaultSleepSeconds, backoffFactor=1,
+            maxSleepSeconds=None, jitter=0, deadlineSeconds=None,
+            maxAttempts=None, wakeEvent=None):
         self.sleepSeconds = sleepSeconds
+        self.backoffFactor = backoffFactor
+        self.maxSleepSeconds = maxSleepSeconds
+        self.jitter = jitter
+        self.deadlineSeconds = deadlineSeconds
+        self.maxAttempts = maxAttempts
+        self.wakeEvent = wakeEvent
 
     def __call__(self, func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            start = _wallClock()
+            sleepSeconds = self.sleepSeconds
+            attempts = 0
             while func(*args, **kwargs):
-                time.sleep(self.sleepSeconds)
+                attempts += 1
+                if (self.maxAttempts is not None and
+                        attempts >= self.maxAttempts):
+                    raise TimeoutException()
+                delay = sleepSeconds
+                if self.jitter:
+                    delay *= 1 + random.uniform(-self.jitter, self.jitter)
+                if self.deadlineSeconds is not None:
+                    remaining = start + self.deadlineSeconds - _wallClock()
+                    if remaining <= 0:
+                        raise TimeoutException()
+                    delay = min(delay, remaining)
+                self._sleep(delay)
+                sleepSeconds *= self.backoffFactor
+                if self.maxSleepSeconds is not None:
+                    sleepSeconds = min(sleepSeconds, self.maxSleepSeconds)
         return wrapper
 
+    def _sleep(self, seconds):
+        if self.wakeEvent is None:
+            time.sleep(seconds)
+        elif self.wakeEvent.wait(seconds):
+            self.wakeEvent.clear()
+
+
+def _raiseInThread(threadId, exceptionType):
+    """
+    Asynchronously raises exceptionType in the thread with threadId the
+    next time it runs Python code, or cancels a pending asynchronous
+    exception if exceptionType is None
+    """
+    if exceptionType is not None:
+        exceptionType = ctypes.py_object(exceptionType)
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_long(threadId), exceptionType)
+
 
 class Timeout(object):
     """
     A decorator to use for only allowing a function to run
-    for a limited amount of time
+    for a limited amount of time.  The time limit may be fractional.
+
+    On the main thread, the limit is enforced with a SIGALRM interval
+    timer.  Timeouts nest: the earliest deadline fires first, and an
+    enclosing timer and its handler are restored afterwards.  On other
+    threads, a watchdog thread raises TimeoutException in the calling
+    thread instead; this interrupts Python code, but not a call that is
+    blocked in C.
     """
     defaultTimeoutSeconds = 60
 
@@ -282,57 +2324,184 @@ class Timeout(object):
         self.timeoutSeconds = timeoutSeconds
 
     def __call__(self, func):
-
-        def _handle_timeout(signum, frame):
-            raise TimeoutException()
-
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            try:
-                # set the alarm and execute func
-                signal.signal(signal.SIGALRM, _handle_timeout)
-                signal.alarm(self.timeoutSeconds)
-                result = func(*args, **kwargs)
-            finally:
-                # clear the alarm
-                signal.alarm(0)
-            return result
+            if not self.timeoutSeconds:
+                return func(*args, **kwargs)
+            if isinstance(threading.current_thread(), threading._MainThread):
+                return self._callWithAlarm(func, args, kwargs)
+            return self._callWithWatchdog(func, args, kwargs)
         return wrapper
 
+    def _callWithAlarm(self, func, args, kwargs):
+        start = _wallClock()
+        # read and disarm any enclosing timer
+        outerRemaining, _ = signal.setitimer(signal.ITIMER_REAL, 0)
+        state = {
+            'ownArmed': not outerRemaining or
+            self.timeoutSeconds <= outerRemaining,
+            'outerFired': False,
+        }
+
+        def handleAlarm(signum, frame):
+            if state['ownArmed']:
+                raise TimeoutException()
+            # the enclosing deadline came first; rearm for our own and
+            # let the enclosing handler react
+            state['ownArmed'] = True
+            state['outerFired'] = True
+            signal.setitimer(signal.ITIMER_REAL, max(
+                start + self.timeoutSeconds - _wallClock(), 1e-6))
+            if callable(previousHandler):
+                previousHandler(signum, frame)
+        handleAlarm.isTimeoutHandler = True
+
+        previousHandler = signal.signal(signal.SIGALRM, handleAlarm)
+        try:
+            if state['ownArmed']:
+                signal.setitimer(signal.ITIMER_REAL, self.timeoutSeconds)
+            else:
+                signal.setitimer(signal.ITIMER_REAL, outerRemaining)
+            return func(*args, **kwargs)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previousHandler)
+            # an enclosing deadline that has passed fires at once.  An
+            # enclosing Timeout whose deadline fired in here fires again,
+            # in case its exception was caught in here; any other
+            # handler has already had its signal.
+            if outerRemaining and (
+                    not state['outerFired'] or
+                    getattr(previousHandler, 'isTimeoutHandler', False)):
+                signal.setitimer(signal.ITIMER_REAL, max(
+                    outerRemaining - (_wallClock() - start), 1e-6))
+
+    def _callWithWatchdog(self, func, args, kwargs):
+        threadId = threading.current_thread().ident
+        lock = threading.Lock()
+        state = {'running': True, 'expired': False}
+
+        def expire():
+            with lock:
+                if state['running']:
+                    state['expired'] = True
+                    _raiseInThread(threadId, TimeoutException)
+
+        watchdog = threading.Timer(self.timeoutSeconds, expire)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            watchdog.cancel()
+            with lock:
+                state['running'] = False
+                if state['expired']:
+                    # func finished before the exception was delivered
+                    _raiseInThread(threadId, None)
+
 
 # ---------------- Context managers ----------------
 
 
 @contextlib.contextmanager
-def suppressOutput():
+def _redirectStandardFds(stdoutFd, stderrFd):
+    """
+    Points the stdout and stderr file descriptors at stdoutFd and
+    stderrFd, restoring them on exit
+    """
     # I would like to use sys.stdout.fileno() and sys.stderr.fileno()
     # here instead of literal fd numbers, but nose does something like
     # sys.stdout = StringIO.StringIO() when the -s flag is not enabled
     # (to capture test output so it doesn't get entangled with nose's
     # display) so the sys.stdout and sys.stderr objects are not able to
     # be accessed here.
+    origStdoutFd = 1
+    origStderrFd = 2
+    origStdout = os.dup(origStdoutFd)
+    origStderr = os.dup(origStderrFd)
     try:
-        # redirect stdout and stderr to /dev/null
-        devnull = open(os.devnull, 'w')
-        origStdoutFd = 1
-        origStderrFd = 2
-        origStdout = os.dup(origStdoutFd)
-        origStderr = os.dup(origStderrFd)
         sys.stdout.flush()
         sys.stderr.flush()
-        os.dup2(devnull.fileno(), origStdoutFd)
-        os.dup2(devnull.fileno(), origStderrFd)
+        os.dup2(stdoutFd, origStdoutFd)
+        os.dup2(stderrFd, origStderrFd)
         # enter the wrapped code
         yield
     finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
         # restore original file streams
-        devnull.flush()
         os.dup2(origStdout, origStdoutFd)
         os.dup2(origStderr, origStderrFd)
         # clean up
         os.close(origStdout)
         os.close(origStderr)
-        devnull.close()
+
+
+@contextlib.contextmanager
+def suppressOutput():
+    """
+    Discards everything written to stdout and stderr, including by C
+    extensions and subprocesses
+    """
+    with open(os.devnull, 'w') as devnull:
+        with _redirectStandardFds(devnull.fileno(), devnull.fileno()):
+            yield
+
+
+class CapturedOutput(object):
+    """
+    The output captured by captureFdOutput.  Once the context exits,
+    stdout and stderr hold the captured bytes, either as a string or,
+    above the memory threshold, as a read-only memory map of the spool
+    file (which supports len(), slicing and the buffer interface).
+    """
+    def __init__(self):
+        self.stdout = None
+        self.stderr = None
+
+
+# file descriptors are process-wide, so only one capture can be active
+# at a time; the lock is reentrant so that captures can nest
+_captureLock = threading.RLock()
+
+
+def _readCapturedOutput(spoolFile, memoryThreshold, tailBytes):
+    spoolFile.flush()
+    size = os.fstat(spoolFile.fileno()).st_size
+    if tailBytes is not None and size > tailBytes:
+        spoolFile.seek(size - tailBytes)
+        return spoolFile.read(tailBytes)
+    if size <= memoryThreshold:
+        spoolFile.seek(0)
+        return spoolFile.read()
+    return mmap.mmap(spoolFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@contextlib.contextmanager
+def captureFdOutput(memoryThreshold=1024 * 1024, tailBytes=None):
+    """
+    Captures everything written to stdout and stderr within the
+    context, including by C extensions and subprocesses, by pointing
+    the file descriptors at anonymous spool files.  Yields a
+    CapturedOutput that is filled in on exit.  Output no larger than
+    memoryThreshold is read into memory; larger output is memory mapped
+    rather than copied.  If tailBytes is given, only the last tailBytes
+    of each stream are kept.  Concurrent captures from other threads
+    wait for this one to finish, but output written by other threads
+    while it is active is captured too.
+    """
+    captured = CapturedOutput()
+    with _captureLock:
+        with tempfile.TemporaryFile() as stdoutFile, \
+                tempfile.TemporaryFile() as stderrFile:
+            with _redirectStandardFds(
+                    stdoutFile.fileno(), stderrFile.fileno()):
+                yield captured
+            captured.stdout = _readCapturedOutput(
+                stdoutFile, memoryThreshold, tailBytes)
+            captured.stderr = _readCapturedOutput(
+                stderrFile, memoryThreshold, tailBytes)
 
 
 @contextlib.contextmanager
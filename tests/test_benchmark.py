@@ -0,0 +1,109 @@
+"""
+Tests for the performance measurement tools
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import tempfile
+import unittest
+
+import ga4gh.common.benchmark as benchmark
+
+
+class TestImportTime(unittest.TestCase):
+
+    # modules that must only be imported when they are first used
+    lazyModules = [
+        'humanize', 'yaml', 'subprocess', 'sqlite3', 'multiprocessing']
+
+    def testLazyImports(self):
+        for moduleName in ['ga4gh.common.utils', 'ga4gh.common.run_tests']:
+            _, importTimes = benchmark.measureImportTime(
+                moduleName, repeats=1)
+            importedNames = set(
+                importTime.name.split('.')[0] for importTime in importTimes)
+            self.assertIn('ga4gh', importedNames)
+            for lazyModule in self.lazyModules:
+                self.assertNotIn(lazyModule, importedNames)
+
+    def testImportTimeReport(self):
+        totalSeconds, importTimes = benchmark.measureImportTime(
+            'ga4gh.common.cli', repeats=2)
+        self.assertGreater(totalSeconds, 0)
+        self.assertIn(
+            'argparse', [importTime.name for importTime in importTimes])
+        report = benchmark.formatImportTimeReport(importTimes)
+        self.assertIn('| ga4gh.common.cli', report)
+
+    def testCheckImportTimeBudget(self):
+        benchmark.checkImportTimeBudget('ga4gh.common.cli', 60, repeats=1)
+        with self.assertRaises(AssertionError):
+            benchmark.checkImportTimeBudget(
+                'ga4gh.common.cli', 0, repeats=1)
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def _createSuite(self):
+        suite = benchmark.BenchmarkSuite()
+        self.workDirs = []
+
+        @benchmark.Benchmark(suite=suite)
+        def listWorkDir(workDir, scale):
+            self.workDirs.append(workDir)
+            for i in range(scale):
+                open(os.path.join(workDir, str(i)), 'w').close()
+            return lambda: os.listdir(workDir)
+        return suite
+
+    def testRunBenchmarks(self):
+        suite = self._createSuite()
+        self.assertEqual(suite.getNames(), ['listWorkDir'])
+        with self.assertRaises(ValueError):
+            benchmark.Benchmark('listWorkDir', suite)(lambda: None)
+        results = benchmark.runBenchmarks(
+            suite, scale=3, repeats=3, minSeconds=0.001)
+        self.assertEqual(results['scale'], 3)
+        result = results['benchmarks']['listWorkDir']
+        self.assertEqual(result['repeats'], 3)
+        self.assertGreater(result['seconds'], 0)
+        self.assertLessEqual(result['seconds'], result['medianSeconds'])
+        self.assertFalse(os.path.exists(self.workDirs[0]))
+
+    def testBuiltinBenchmarks(self):
+        names = benchmark.benchmarkSuite.getNames()
+        for name in [
+                'getFilePathsWithExtensionsInDirectory', 'runCommand',
+                'captureOutput', 'Timed', 'Repeat', 'Timeout']:
+            self.assertIn(name, names)
+        results = benchmark.runBenchmarks(
+            names=['Timed', 'Repeat', 'Timeout'], repeats=1, minSeconds=0)
+        self.assertEqual(len(results['benchmarks']), 3)
+
+    def testCompareResults(self):
+        def makeResults(**secondsByName):
+            return {'benchmarks': dict(
+                (name, {'seconds': seconds})
+                for name, seconds in secondsByName.items())}
+        baseline = makeResults(fast=1.0, slow=1.0)
+        results = makeResults(fast=1.1, slow=1.5, new=1.0)
+        _, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        benchmark.saveResults(baseline, path)
+        comparisons = benchmark.compareResults(
+            results, benchmark.loadResults(path), threshold=0.2)
+        self.assertEqual(
+            [(comparison.name, comparison.regressed)
+             for comparison in comparisons],
+            [('fast', False), ('new', False), ('slow', True)])
+        self.assertIsNone(comparisons[1].baselineSeconds)
+        self.assertAlmostEqual(comparisons[2].ratio, 1.5)
+        comparisons = benchmark.compareResults(
+            results, baseline, threshold=0.2, thresholds={'slow': 0.6})
+        self.assertFalse(any(
+            comparison.regressed for comparison in comparisons))
+        report = benchmark.formatComparisonReport(comparisons)
+        self.assertIn('slow', report)
+        self.assertNotIn('REGRESSED', report)
@@ -0,0 +1,206 @@
+"""
+Tests for the Travis CI emulator
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import mock
+import os
+import subprocess
+import tempfile
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+import ga4gh.common.run_tests as run_tests
+
+
+class TestTravisSimulator(unittest.TestCase):
+    """
+    Runs the simulator against a temporary .travis.yml
+    """
+    printMock = mock.Mock()
+
+    def setUp(self):
+        self.printMock.reset_mock()
+
+    def _createSimulator(self, script, **kwargs):
+        _, path = tempfile.mkstemp()
+        with open(path, 'w') as yamlFile:
+            yamlFile.write("script:\n")
+            for command in script:
+                yamlFile.write("  - '{}'\n".format(command))
+        self.addCleanup(os.remove, path)
+        simulator = run_tests.TravisSimulator(**kwargs)
+        simulator.yamlFileLocation = path
+        return simulator
+
+    def testParseTestStages(self):
+        simulator = self._createSimulator([
+            'echo c  # stage: 2', 'echo a', 'echo b # stage: 1', 'echo d'])
+        stages = simulator.parseTestStages()
+        self.assertEqual(
+            stages, [['echo a', 'echo d'], ['echo b'], ['echo c']])
+
+    @mock.patch('__builtin__.print', printMock)
+    def testRunTestsParallel(self):
+        simulator = self._createSimulator(
+            ['echo -n', 'true', 'echo -n # stage: 1'], jobs=2)
+        with mock.patch('sys.stdout'):
+            simulator.runTests()
+
+    @mock.patch('__builtin__.print', printMock)
+    def testRunTestsParallelFailure(self):
+        simulator = self._createSimulator(
+            ['true', 'false', 'doesNotExistAsAnExecutable'], jobs=2)
+        with mock.patch('sys.stdout'):
+            with self.assertRaises(subprocess.CalledProcessError):
+                simulator.runTests()
+
+    @mock.patch('__builtin__.print', printMock)
+    def testRunTestsSerialStopsAtFirstFailure(self):
+        simulator = self._createSimulator(['true', 'false', 'echo notRun'])
+        with mock.patch('sys.stdout'):
+            with self.assertRaises(subprocess.CalledProcessError):
+                simulator.runTests()
+        self.assertEqual(
+            [usage.command for usage in simulator.usages], ['true', 'false'])
+
+    @mock.patch('__builtin__.print', printMock)
+    def testRunTestsCached(self):
+        treeRoot = tempfile.mkdtemp()
+        with open(os.path.join(treeRoot, 'source.py'), 'w') as sourceFile:
+            sourceFile.write('pass\n')
+        cache = run_tests.TestResultCache(
+            directory=os.path.join(treeRoot, 'cache'), treeRoot=treeRoot)
+        simulator = self._createSimulator(['echo hello'], cache=cache)
+        with mock.patch('sys.stdout'):
+            simulator.runTests()
+        self.assertEqual(cache.get('echo hello'), b'hello\n')
+        with mock.patch('sys.stdout'), mock.patch(
+                'ga4gh.common.run_tests._runTestCommand') as runMock:
+            simulator.runTests()
+        self.assertEqual(runMock.call_count, 0)
+
+    @mock.patch('__builtin__.print', printMock)
+    def testResourceUsageReport(self):
+        reportDir = tempfile.mkdtemp()
+        jsonPath = os.path.join(reportDir, 'report.json')
+        simulator = self._createSimulator(
+            ['true', 'echo hello', 'false'], reportPath=jsonPath)
+        with mock.patch('sys.stdout'):
+            with self.assertRaises(subprocess.CalledProcessError):
+                simulator.runTests()
+        self.assertEqual(
+            [(usage.command, usage.returncode) for usage in simulator.usages],
+            [('true', 0), ('echo hello', 0), ('false', 1)])
+        for usage in simulator.usages:
+            self.assertGreater(usage.wallSeconds, 0)
+            self.assertGreater(usage.maxRssBytes, 0)
+        table = self.printMock.call_args[0][0]
+        self.assertIn('echo hello', table)
+        with open(jsonPath) as reportFile:
+            report = json.load(reportFile)
+        self.assertEqual(report[2]['returncode'], 1)
+
+        xmlPath = os.path.join(reportDir, 'report.xml')
+        run_tests.writeUsageReport(simulator.usages, xmlPath)
+        suite = ElementTree.parse(xmlPath).getroot()
+        self.assertEqual(suite.get('tests'), '3')
+        self.assertEqual(suite.get('failures'), '1')
+        self.assertEqual(
+            [testCase.find('failure') is not None
+             for testCase in suite.findall('testcase')],
+            [False, False, True])
+
+    def testRunnerRss(self):
+        megabyte = 1024 * 1024
+        usages = [
+            run_tests.CommandUsage(
+                'small', 0, 1, 0, 0, 40 * megabyte, 50 * megabyte, False),
+            run_tests.CommandUsage(
+                'large', 0, 2, 0, 0, 90 * megabyte, 50 * megabyte, False)]
+        lines = run_tests.formatUsageTable(usages).split('\n')
+        self.assertIn(' 90.0 ', lines[1])
+        self.assertIn(' <=50.0 ', lines[2])
+        self.assertTrue(lines[3].startswith('<=:'))
+        reportPath = os.path.join(tempfile.mkdtemp(), 'report.json')
+        run_tests.writeUsageReport(usages, reportPath)
+        with open(reportPath) as reportFile:
+            report = json.load(reportFile)
+        self.assertEqual(
+            [usage['maxRssIsRunners'] for usage in report], [True, False])
+
+
+class TestCommandHistory(unittest.TestCase):
+
+    def _makeUsage(self, command, wallSeconds, returncode=0, cached=False):
+        return run_tests.CommandUsage(
+            command, returncode, wallSeconds, 0, 0, 0, 0, cached)
+
+    def testFindSlowdowns(self):
+        history = run_tests.CommandHistory(
+            os.path.join(tempfile.mkdtemp(), 'cache', 'history'),
+            maxRuns=3, slowdownThreshold=0.5)
+        self.assertIsNone(history.getMedianSeconds('a'))
+        for seconds in [1, 2, 3, 100]:
+            history.record([
+                self._makeUsage('a', seconds),
+                self._makeUsage('failed', seconds, returncode=1),
+                self._makeUsage('cached', seconds, cached=True)])
+        # only the last three runs are kept
+        self.assertEqual(history.getMedianSeconds('a'), 3)
+        self.assertIsNone(history.getMedianSeconds('failed'))
+        self.assertIsNone(history.getMedianSeconds('cached'))
+        slow = self._makeUsage('a', 5)
+        slowdowns = history.findSlowdowns([
+            self._makeUsage('a', 4), slow, self._makeUsage('b', 50)])
+        self.assertEqual(slowdowns, [(slow, 3)])
+
+
+class TestTestResultCache(unittest.TestCase):
+
+    def _createCache(self, **kwargs):
+        treeRoot = tempfile.mkdtemp()
+        self.sourcePath = os.path.join(treeRoot, 'source.py')
+        with open(self.sourcePath, 'w') as sourceFile:
+            sourceFile.write('pass\n')
+        return run_tests.TestResultCache(
+            directory=os.path.join(treeRoot, 'cache'), treeRoot=treeRoot,
+            **kwargs)
+
+    def testGetPut(self):
+        cache = self._createCache()
+        self.assertIsNone(cache.get('command'))
+        cache.put('command', b'output')
+        self.assertEqual(cache.get('command'), b'output')
+        self.assertIsNone(cache.get('otherCommand'))
+        # a change to the tree invalidates the entry
+        with open(self.sourcePath, 'a') as sourceFile:
+            sourceFile.write('pass\n')
+        newCache = run_tests.TestResultCache(
+            directory=cache.directory, treeRoot=cache.treeRoot)
+        self.assertIsNone(newCache.get('command'))
+
+    def testExcludeDirs(self):
+        cache = self._createCache()
+        cache.put('command', b'output')
+        venvDir = os.path.join(cache.treeRoot, 'venv')
+        os.mkdir(venvDir)
+        with open(os.path.join(venvDir, 'module.py'), 'w') as sourceFile:
+            sourceFile.write('pass\n')
+        newCache = run_tests.TestResultCache(
+            directory=cache.directory, treeRoot=cache.treeRoot)
+        self.assertEqual(newCache.get('command'), b'output')
+
+    def testEvict(self):
+        cache = self._createCache(maxBytes=200)
+        for i in range(10):
+            cache.put('command{}'.format(i), b'x' * 50)
+        entrySizes = [
+            os.path.getsize(os.path.join(cache.directory, fileName))
+            for fileName in os.listdir(cache.directory)]
+        self.assertLessEqual(sum(entrySizes), 200)
+        self.assertIsNotNone(cache.get('command9'))
+        self.assertIsNone(cache.get('command0'))
@@ -5,12 +5,19 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import gzip
+import json
+import logging
 import mock
+import signal
 import tempfile
 import subprocess
+import threading
+import time
 import unittest
 import sys
 import os
+import yaml
 
 import ga4gh.common.utils as utils
 
@@ -33,6 +40,52 @@ class TestUtils(AbstractTestUtils):
         notFoundPath = utils.getPathOfExecutable(self.nonexistentExecutable)
         self.assertIsNone(notFoundPath)
 
+    def testGetPathsOfExecutables(self):
+        paths = utils.getPathsOfExecutables(
+            self.executables + [self.nonexistentExecutable])
+        for executable in self.executables:
+            self.assertEqual(
+                os.path.basename(paths[executable]), executable)
+        self.assertIsNone(paths[self.nonexistentExecutable])
+
+    def testGetPathOfExecutableInvalidation(self):
+        firstDir = tempfile.mkdtemp()
+        secondDir = tempfile.mkdtemp()
+        executable = 'anExecutable'
+        secondPath = os.path.join(secondDir, executable)
+        utils.touch(secondPath)
+        os.chmod(secondPath, 0o755)
+        path = os.pathsep.join([firstDir, secondDir])
+        with mock.patch.dict(os.environ, {'PATH': path}):
+            self.assertEqual(
+                utils.getPathOfExecutable(executable), secondPath)
+            # the first match on the path wins
+            firstPath = os.path.join(firstDir, executable)
+            utils.touch(firstPath)
+            os.chmod(firstPath, 0o755)
+            os.utime(firstDir, (0, 0))
+            self.assertEqual(
+                utils.getPathOfExecutable(executable), firstPath)
+        with mock.patch.dict(os.environ, {'PATH': secondDir}):
+            self.assertEqual(
+                utils.getPathOfExecutable(executable), secondPath)
+
+    def testGetPathOfExecutableNotCachedWhenMissing(self):
+        directory = tempfile.mkdtemp()
+        executable = 'anExecutable'
+        path = os.path.join(directory, executable)
+        with mock.patch.dict(os.environ, {'PATH': directory}):
+            self.assertIsNone(utils.getPathOfExecutable(executable))
+            # added within the same mtime tick as the listing
+            utils.touch(path)
+            os.chmod(path, 0o755)
+            self.assertEqual(utils.getPathOfExecutable(executable), path)
+            # chmod doesn't change the directory's mtime
+            os.chmod(path, 0o644)
+            self.assertIsNone(utils.getPathOfExecutable(executable))
+            os.chmod(path, 0o755)
+            self.assertEqual(utils.getPathOfExecutable(executable), path)
+
     def testRunCommand(self):
         utils.runCommand(self.validCommand)
         with self.assertRaises(subprocess.CalledProcessError):
@@ -48,6 +101,34 @@ class TestUtils(AbstractTestUtils):
         with self.assertRaises(Exception):
             utils.runCommandReturnOutput(self.nonexistentExecutable)
 
+    def testRunCommandStreamOutput(self):
+        command = "sh -c 'echo one; echo two 1>&2; echo three'"
+        lines = list(utils.runCommandStreamOutput(command))
+        stdoutLines = [line for name, line in lines if name == 'stdout']
+        stderrLines = [line for name, line in lines if name == 'stderr']
+        self.assertEqual(stdoutLines, [b'one\n', b'three\n'])
+        self.assertEqual(stderrLines, [b'two\n'])
+        callbackLines = []
+        command = "sh -c 'seq 1000; exit 3'"
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            for _ in utils.runCommandStreamOutput(
+                    command, tailBytes=8,
+                    lineCallback=lambda name, line: callbackLines.append(
+                        line)):
+                pass
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(context.exception.output[-8:], b'999\n1000\n'[-8:])
+        self.assertEqual(len(callbackLines), 1000)
+        # output shorter than the tail is kept whole
+        command = "sh -c 'printf 0123456789; exit 2'"
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            list(utils.runCommandStreamOutput(command, tailBytes=16))
+        self.assertEqual(context.exception.output, b'0123456789')
+        # stopping early kills the command
+        stream = utils.runCommandStreamOutput('yes')
+        self.assertEqual(next(stream), ('stdout', b'y\n'))
+        stream.close()
+
     def testRunCommandSplits(self):
         utils.runCommandSplits(self.validCommand.split())
         with self.assertRaises(subprocess.CalledProcessError):
@@ -55,6 +136,78 @@ class TestUtils(AbstractTestUtils):
         with self.assertRaises(Exception):
             utils.runCommand([self.nonexistentExecutable], silent=True)
 
+    def testCommandExecutor(self):
+        executor = utils.CommandExecutor(maxConcurrent=2)
+        handles = [executor.submitCommand(self.validCommand)
+                   for _ in range(4)]
+        for handle in handles:
+            self.assertIsNone(handle.result())
+            self.assertTrue(handle.done())
+        handle = executor.submitCommandReturnOutput('echo output')
+        self.assertEqual(handle.result(), (b'output\n', b''))
+        handle = executor.submitCommand(self.invalidCommand, silent=True)
+        with self.assertRaises(subprocess.CalledProcessError):
+            handle.result()
+        handle = executor.submitCommandReturnOutput(self.invalidCommand)
+        with self.assertRaises(subprocess.CalledProcessError):
+            handle.result()
+        handle = executor.submitCommandSplits([self.nonexistentExecutable])
+        with self.assertRaises(Exception):
+            handle.result()
+        executor.shutdown()
+
+    def testCommandExecutorTimeoutAndCancel(self):
+        executor = utils.CommandExecutor()
+        handle = executor.submitCommand('sleep 10', timeoutSeconds=0.1)
+        with self.assertRaises(utils.TimeoutException):
+            handle.result()
+        handle = executor.submitCommand('sleep 10')
+        with self.assertRaises(utils.TimeoutException):
+            handle.result(timeout=0.1)
+        handle.cancel()
+        with self.assertRaises(utils.CommandCancelledException):
+            handle.result()
+        executor.shutdown()
+
+    def testCommandExecutorCancelQueuedAndShutdown(self):
+        with utils.CommandExecutor(maxConcurrent=1) as executor:
+            running = executor.submitCommand('sleep 10')
+            queued = executor.submitCommand(self.validCommand)
+            # a queued command is done as soon as it is cancelled
+            queued.cancel()
+            self.assertTrue(queued.done())
+            with self.assertRaises(utils.CommandCancelledException):
+                queued.result(timeout=1)
+            running.cancel()
+        for worker in executor._workers:
+            self.assertFalse(worker.is_alive())
+        with self.assertRaises(RuntimeError):
+            executor.submitCommand(self.validCommand)
+
+    def testRunCommands(self):
+        commands = ['echo one', 'echo two', self.validCommand]
+        results = utils.runCommands(commands, maxWorkers=2)
+        self.assertEqual(
+            [result.command for result in results], commands)
+        self.assertEqual(
+            [result.output for result in results], [b'one\n', b'two\n', b''])
+        self.assertEqual(
+            [result.returncode for result in results], [0, 0, 0])
+        results = utils.runCommands(['printf abcdefghij'], tailBytes=16)
+        self.assertEqual(results[0].output, b'abcdefghij')
+        commands = [
+            'false', self.validCommand, self.nonexistentExecutable]
+        with self.assertRaises(utils.CommandsFailedException) as context:
+            utils.runCommands(commands)
+        failures = context.exception.failures
+        self.assertEqual(
+            [failure.command for failure in failures],
+            ['false', self.nonexistentExecutable])
+        self.assertIn(self.nonexistentExecutable, str(context.exception))
+        with self.assertRaises(utils.CommandsFailedException) as context:
+            utils.runCommands(['false', 'true'], maxWorkers=1, failFast=True)
+        self.assertIsNone(context.exception.results[1])
+
     def testGetYamlDocument(self):
         yamlText = """
 provider:
@@ -65,6 +218,57 @@ provider:
             yamlFile.write(yamlText)
         doc = utils.getYamlDocument(path)
         self.assertEqual(doc, {'provider': {'key': 'aKey'}})
+        # cached documents can't be modified through returned copies
+        doc['provider']['key'] = 'modified'
+        doc = utils.getYamlDocument(path)
+        self.assertEqual(doc, {'provider': {'key': 'aKey'}})
+        with open(path, 'w') as yamlFile:
+            yamlFile.write("provider: changed")
+        doc = utils.getYamlDocument(path)
+        self.assertEqual(doc, {'provider': 'changed'})
+        self.assertEqual(
+            utils.getYamlDocument(path, useCache=False), doc)
+        # only standard tags are accepted
+        with open(path, 'w') as yamlFile:
+            yamlFile.write("!!python/object/apply:os.getcwd []")
+        with self.assertRaises(yaml.YAMLError):
+            utils.getYamlDocument(path)
+
+    def testGetYamlDocumentRacyRewrite(self):
+        _, path = tempfile.mkstemp()
+        with open(path, 'w') as yamlFile:
+            yamlFile.write("key: aaa")
+        self.assertEqual(utils.getYamlDocument(path), {'key': 'aaa'})
+        mtime = os.stat(path).st_mtime
+        # a same size rewrite within the same mtime tick
+        with open(path, 'w') as yamlFile:
+            yamlFile.write("key: bbb")
+        os.utime(path, (mtime, mtime))
+        self.assertEqual(utils.getYamlDocument(path), {'key': 'bbb'})
+        # a file that hasn't changed for a while is cached
+        os.utime(path, (mtime - 10, mtime - 10))
+        self.assertEqual(utils.getYamlDocument(path), {'key': 'bbb'})
+        with open(path, 'w') as yamlFile:
+            yamlFile.write("key: ccc")
+        os.utime(path, (mtime - 10, mtime - 10))
+        self.assertEqual(utils.getYamlDocument(path), {'key': 'bbb'})
+
+    def testGetYamlDocumentMissing(self):
+        path = os.path.join(tempfile.mkdtemp(), 'missing.yml')
+        for useCache in [True, False]:
+            with self.assertRaises(IOError):
+                utils.getYamlDocument(path, useCache=useCache)
+
+    def testIterYamlDocuments(self):
+        yamlText = "- &anchor {key: 1}\n- *anchor\n--- \n- 2\n---\nkey: 3\n"
+        _, path = tempfile.mkstemp()
+        with open(path, 'w') as yamlFile:
+            yamlFile.write(yamlText)
+        docs = list(utils.iterYamlDocuments(path))
+        self.assertEqual(
+            docs, [[{'key': 1}, {'key': 1}], [2], {'key': 3}])
+        items = list(utils.iterYamlItems(path))
+        self.assertEqual(items, [{'key': 1}, {'key': 1}, 2, {'key': 3}])
 
     def testZipLists(self):
         a = [1, 2]
@@ -79,6 +283,21 @@ provider:
         with self.assertRaises(AssertionError):
             utils.zipLists(d, e)
 
+    def testZipIterators(self):
+        result = utils.zipIterators(iter([1, 2]), (x for x in [3, 4]))
+        self.assertEqual(list(result), [(1, 3), (2, 4)])
+        result = utils.zipIterators(iter([1, 2, 3]), iter([4, 5]))
+        self.assertEqual(next(result), (1, 4))
+        self.assertEqual(next(result), (2, 5))
+        with self.assertRaises(AssertionError) as context:
+            next(result)
+        self.assertIn("index 1 has length 2", str(context.exception))
+        with self.assertRaises(AssertionError) as context:
+            list(utils.zipIterators([1], [2], [3, 4]))
+        self.assertIn("index 2 has more than 1", str(context.exception))
+        with self.assertRaises(AssertionError):
+            list(utils.zipIterators([1], [2, 3], [4, 5]))
+
     def testGetLinesFromLogFile(self):
         handle, path = tempfile.mkstemp()
         message = 'aMessage'
@@ -88,12 +307,220 @@ provider:
             result = utils.getLinesFromLogFile(readFile)
         self.assertEqual(result, [message])
 
+    def testLogFileTailer(self):
+        tree = tempfile.mkdtemp('testLogFileTailer')
+        path = os.path.join(tree, 'log.txt')
+        tailer = utils.LogFileTailer(path)
+        self.assertEqual(tailer.readLines(), [])
+        with open(path, 'w') as logFile:
+            logFile.write('one\ntw')
+        self.assertEqual(tailer.readLines(), [b'one\n'])
+        self.assertEqual(tailer.readLines(), [])
+        with open(path, 'a') as logFile:
+            logFile.write('o\nthree\n')
+        self.assertEqual(tailer.readLines(), [b'two\n', b'three\n'])
+        # truncation
+        with open(path, 'w') as logFile:
+            logFile.write('four\n')
+        self.assertEqual(tailer.readLines(), [b'four\n'])
+        # rotation
+        with open(path, 'a') as logFile:
+            logFile.write('five\nsi')
+        os.rename(path, path + '.1')
+        with open(path, 'w') as logFile:
+            logFile.write('six\n')
+        self.assertEqual(
+            tailer.readLines(), [b'five\n', b'si', b'six\n'])
+        self.assertEqual(tailer.waitForLines(timeoutSeconds=0.05), [])
+
+        def appendLater():
+            time.sleep(0.05)
+            with open(path, 'a') as logFile:
+                logFile.write('seven\n')
+        thread = threading.Thread(target=appendLater)
+        thread.start()
+        self.assertEqual(
+            tailer.waitForLines(timeoutSeconds=10, pollSeconds=0.01),
+            [b'seven\n'])
+        thread.join()
+        tailer.close()
+
+    def testWallClockMonotonic(self):
+        if not sys.platform.startswith('linux'):
+            return
+        with mock.patch('time.time', side_effect=[1e9, 0]):
+            first = utils._wallClock()
+            second = utils._wallClock()
+        self.assertLessEqual(first, second)
+        self.assertLess(second, 1e9)
+
     def testPowerset(self):
         s = [1, 2, 3]
         expected = [
             (), (1, ), (2, ), (3, ), (1, 2), (1, 3), (2, 3), (1, 2, 3)]
         result = list(utils.powerset(s))
         self.assertEqual(result, expected)
+        result = list(utils.powerset(s, maxSets=3))
+        self.assertEqual(result, expected[:3])
+        result = list(utils.powerset(s, minSize=1, maxSize=2))
+        self.assertEqual(result, expected[1:7])
+
+    def testSubsetIndexing(self):
+        items = ['a', 'b', 'c', 'd', 'e']
+        for minSize, maxSize in [(0, None), (2, 3)]:
+            subsets = list(utils.powerset(
+                items, minSize=minSize, maxSize=maxSize))
+            self.assertEqual(
+                utils.countSubsets(items, minSize, maxSize), len(subsets))
+            for index, subset in enumerate(subsets):
+                self.assertEqual(utils.getSubsetAtIndex(
+                    items, index, minSize, maxSize), subset)
+                self.assertEqual(utils.getSubsetIndex(
+                    items, subset, minSize, maxSize), index)
+                self.assertEqual(
+                    list(utils.iterSubsets(
+                        items, index, minSize=minSize, maxSize=maxSize)),
+                    subsets[index:])
+            shards = [
+                list(utils.shardSubsets(items, i, 3, minSize, maxSize))
+                for i in range(3)]
+            self.assertEqual(sum(shards, []), subsets)
+        with self.assertRaises(IndexError):
+            utils.getSubsetAtIndex(items, 32)
+        samples = utils.sampleSubsets(items, 20, minSize=2, maxSize=2)
+        self.assertEqual(len(samples), 20)
+        for sample in samples:
+            self.assertEqual(len(sample), 2)
+
+    def testTraced(self):
+        @utils.Traced(name='traced')
+        def tracedFunc(value):
+            return value
+
+        _, path = tempfile.mkstemp()
+        self.assertEqual(tracedFunc(1), 1)
+        utils.enableTracing(path, sampleEvery=3)
+        try:
+            for i in range(7):
+                self.assertEqual(tracedFunc(i), i)
+        finally:
+            utils.disableTracing()
+        self.assertEqual(tracedFunc(2), 2)
+        with open(path) as traceFile:
+            records = [json.loads(line) for line in traceFile]
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0]['name'], 'traced')
+        self.assertIn('cpuSeconds', records[0])
+
+    def testTimedTraceMode(self):
+        registry = utils.TimingRegistry()
+
+        @utils.Timed(registry=registry, name='timed', trace=True)
+        def timedFunc():
+            pass
+
+        _, path = tempfile.mkstemp()
+        timedFunc()
+        utils.enableTracing(path)
+        try:
+            timedFunc()
+        finally:
+            utils.disableTracing()
+        with open(path) as traceFile:
+            records = [json.loads(line) for line in traceFile]
+        self.assertEqual([record['name'] for record in records], ['timed'])
+        self.assertIsNone(registry.getStats('timed'))
+
+    def testSampleEveryValidated(self):
+        _, path = tempfile.mkstemp()
+        with self.assertRaises(ValueError):
+            utils.enableTracing(path, sampleEvery=0)
+        with self.assertRaises(ValueError):
+            utils.Traced(sampleEvery=0)
+        with self.assertRaises(ValueError):
+            utils.Timed(trace=True, sampleEvery=-1)
+
+    def testMemoized(self):
+        registry = utils.TimingRegistry()
+        calls = []
+
+        @utils.Memoized(maxSize=2, registry=registry, name='memoized')
+        def memoizedFunc(value, scale=1):
+            calls.append(value)
+            return value * scale
+
+        self.assertEqual(memoizedFunc(1), 1)
+        self.assertEqual(memoizedFunc(1), 1)
+        self.assertEqual(memoizedFunc(1, scale=3), 3)
+        self.assertEqual(memoizedFunc(2), 2)
+        self.assertEqual(memoizedFunc(1), 1)
+        self.assertEqual(calls, [1, 1, 2, 1])
+        self.assertEqual(memoizedFunc([3]), [3])
+        info = memoizedFunc.cacheInfo()
+        self.assertEqual(
+            (info['hits'], info['misses'], info['evictions'], info['size']),
+            (1, 4, 2, 2))
+        self.assertEqual(
+            registry.getCounters('memoized'),
+            {'hits': 1, 'misses': 4, 'evictions': 2})
+        self.assertIn(
+            'ga4gh_events_total{function="memoized",event="hits"} 1',
+            registry.toPrometheus())
+        memoizedFunc.cacheClear()
+        self.assertEqual(memoizedFunc.cacheInfo()['size'], 0)
+
+    def testMemoizedTtl(self):
+        calls = []
+
+        @utils.Memoized(ttlSeconds=0.01, registry=utils.TimingRegistry())
+        def memoizedFunc():
+            calls.append(1)
+        memoizedFunc()
+        memoizedFunc()
+        time.sleep(0.02)
+        memoizedFunc()
+        self.assertEqual(len(calls), 2)
+
+    def testMemoizedSingleFlight(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        @utils.Memoized(registry=utils.TimingRegistry())
+        def slowFunc():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return len(calls)
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(slowFunc()))
+            for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [1, 1, 1, 1])
+
+    def testMemoizedBaseException(self):
+        calls = []
+
+        @utils.Memoized(registry=utils.TimingRegistry())
+        def interruptedFunc():
+            calls.append(1)
+            if len(calls) == 1:
+                raise KeyboardInterrupt()
+            return len(calls)
+
+        with self.assertRaises(KeyboardInterrupt):
+            interruptedFunc()
+        self.assertEqual(interruptedFunc(), 2)
+        self.assertEqual(interruptedFunc(), 2)
 
     def testRepeat(self):
         aList = []
@@ -105,6 +532,38 @@ provider:
         repeatFunc()
         self.assertEqual(aList, [1, 1, 1])
 
+    def testRepeatBackoff(self):
+        with mock.patch('time.sleep') as sleepMock:
+            @utils.Repeat(
+                sleepSeconds=1, backoffFactor=2, maxSleepSeconds=5,
+                maxAttempts=6)
+            def repeatFunc():
+                return True
+            with self.assertRaises(utils.TimeoutException):
+                repeatFunc()
+        delays = [call[0][0] for call in sleepMock.call_args_list]
+        self.assertEqual(delays, [1, 2, 4, 5, 5])
+
+    def testRepeatDeadlineAndWake(self):
+        @utils.Repeat(sleepSeconds=0.01, deadlineSeconds=0.05)
+        def repeatForeverFunc():
+            return True
+        with self.assertRaises(utils.TimeoutException):
+            repeatForeverFunc()
+
+        wakeEvent = threading.Event()
+        aList = []
+
+        @utils.Repeat(sleepSeconds=60, jitter=0.5, wakeEvent=wakeEvent)
+        def repeatFunc():
+            aList.append(1)
+            wakeEvent.set()
+            return len(aList) < 3
+        start = time.time()
+        repeatFunc()
+        self.assertEqual(aList, [1, 1, 1])
+        self.assertLess(time.time() - start, 30)
+
     def testTimeout(self):
 
         @utils.Timeout(1)
@@ -114,6 +573,78 @@ provider:
         with self.assertRaises(utils.TimeoutException):
             timeoutFunc()
 
+    def testTimeoutFractional(self):
+        @utils.Timeout(0.1)
+        def timeoutFunc():
+            time.sleep(10)
+        start = time.time()
+        with self.assertRaises(utils.TimeoutException):
+            timeoutFunc()
+        self.assertLess(time.time() - start, 5)
+
+    def testTimeoutNested(self):
+        @utils.Timeout(0.1)
+        def innerFunc():
+            time.sleep(10)
+
+        @utils.Timeout(5)
+        def outerFunc():
+            with self.assertRaises(utils.TimeoutException):
+                innerFunc()
+            remaining, _ = signal.getitimer(signal.ITIMER_REAL)
+            self.assertGreater(remaining, 4)
+            self.assertLess(remaining, 5)
+        outerFunc()
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL)[0], 0)
+
+        @utils.Timeout(0.1)
+        def outerFirstFunc():
+            utils.Timeout(5)(time.sleep)(10)
+        with self.assertRaises(utils.TimeoutException):
+            outerFirstFunc()
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL)[0], 0)
+
+    def testTimeoutNestedOuterCaughtInside(self):
+        # the enclosing deadline still holds after its exception is
+        # caught inside the inner scope
+        @utils.Timeout(1)
+        def innerFunc():
+            try:
+                time.sleep(0.4)
+            except utils.TimeoutException:
+                pass
+
+        @utils.Timeout(0.2)
+        def outerFunc():
+            innerFunc()
+            time.sleep(10)
+        start = time.time()
+        with self.assertRaises(utils.TimeoutException):
+            outerFunc()
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL)[0], 0)
+
+    def testTimeoutThread(self):
+        @utils.Timeout(0.1)
+        def timeoutFunc():
+            while True:
+                pass
+
+        @utils.Timeout(5)
+        def quickFunc():
+            return 1
+
+        results = []
+
+        def run():
+            with self.assertRaises(utils.TimeoutException):
+                timeoutFunc()
+            results.append(quickFunc())
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join(10)
+        self.assertEqual(results, [1])
+
     def testSuppressOutput(self):
         # not really sure how to test this
         with utils.suppressOutput():
@@ -133,6 +664,27 @@ provider:
         with self.assertRaises(AssertionError):
             utils.chomp(chomped)
 
+    def testIterChompedLines(self):
+        _, path = tempfile.mkstemp()
+        with open(path, 'w') as textFile:
+            textFile.write('one\ntwo\r\n\nthree\r\nfour')
+        expected = [b'one', b'two', b'', b'three', b'four']
+        for chunkSize in [1, 4, 1024]:
+            for useMmap in [False, True]:
+                lines = utils.iterChompedLines(
+                    path, chunkSize=chunkSize, useMmap=useMmap)
+                self.assertEqual(list(lines), expected)
+        batches = list(utils.iterChompedLineBatches(path, chunkSize=9))
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(batches, []), expected)
+        with self.assertRaises(AssertionError):
+            list(utils.iterChompedLines(
+                path, allowMissingFinalNewline=False))
+        with gzip.open(path, 'w') as textFile:
+            textFile.write('one\ntwo\n')
+        self.assertEqual(
+            list(utils.iterChompedLines(path)), [b'one', b'two'])
+
     def testGetFilePathsWithExtensionsInDirectory(self):
         def createTempTree():
             tree = tempfile.mkdtemp('getFilePathsWithExtensionsInDirectory')
@@ -166,6 +718,82 @@ provider:
             tree, patterns)
         self.assertEqual(filePaths, sortedFilePaths)
 
+    def testIterFilePathsWithExtensionsInDirectory(self):
+        tree = tempfile.mkdtemp('iterFilePathsWithExtensionsInDirectory')
+        for dirPath in ['a', 'a-b', 'a/c', 'skip', 'z']:
+            os.mkdir(os.path.join(tree, dirPath))
+        for filePath in [
+                'a.foo', 'a/b.foo', 'a/c/d.foo', 'a-b/e.foo', 'a0.foo',
+                'skip/f.foo', 'z/g.foo', 'z/h.bar']:
+            utils.touch(os.path.join(tree, filePath))
+        os.symlink(os.path.join(tree, 'a'), os.path.join(tree, 'link'))
+        expected = sorted(
+            os.path.join(tree, filePath) for filePath in [
+                'a.foo', 'a/b.foo', 'a/c/d.foo', 'a-b/e.foo', 'a0.foo',
+                'z/g.foo'])
+        for numThreads in [1, 3]:
+            filePaths = utils.iterFilePathsWithExtensionsInDirectory(
+                tree, ['*.foo'], sort=True, excludeDirs=['sk*'],
+                numThreads=numThreads)
+            self.assertEqual(list(filePaths), expected)
+            filePaths = utils.iterFilePathsWithExtensionsInDirectory(
+                tree, ['*.foo'], excludeDirs=['sk*'], numThreads=numThreads)
+            self.assertEqual(sorted(filePaths), expected)
+
+    def testFileIndex(self):
+        tree = tempfile.mkdtemp('testFileIndex')
+        os.mkdir(os.path.join(tree, 'a'))
+        os.mkdir(os.path.join(tree, 'a', 'b'))
+        for filePath in ['c.foo', 'a/d.foo', 'a/b/e.foo', 'a/f.bar']:
+            utils.touch(os.path.join(tree, filePath))
+        _, indexPath = tempfile.mkstemp()
+
+        def scan():
+            fileIndex = utils.FileIndex(indexPath, tree, ['*.foo'])
+            try:
+                return fileIndex.scan()
+            finally:
+                fileIndex.close()
+
+        def paths(*filePaths):
+            return [os.path.join(tree, filePath) for filePath in filePaths]
+
+        result = scan()
+        self.assertEqual(
+            result.filePaths, paths('a/b/e.foo', 'a/d.foo', 'c.foo'))
+        self.assertEqual(result.addedFilePaths, result.filePaths)
+        self.assertEqual(result.removedFilePaths, [])
+        result = scan()
+        self.assertEqual(result.addedFilePaths, [])
+        self.assertEqual(result.removedFilePaths, [])
+        utils.touch(os.path.join(tree, 'a', 'b', 'g.foo'))
+        os.remove(os.path.join(tree, 'a', 'd.foo'))
+        result = scan()
+        self.assertEqual(
+            result.filePaths, paths('a/b/e.foo', 'a/b/g.foo', 'c.foo'))
+        self.assertEqual(result.addedFilePaths, paths('a/b/g.foo'))
+        self.assertEqual(result.removedFilePaths, paths('a/d.foo'))
+        os.remove(os.path.join(tree, 'a', 'b', 'e.foo'))
+        os.remove(os.path.join(tree, 'a', 'b', 'g.foo'))
+        os.rmdir(os.path.join(tree, 'a', 'b'))
+        result = scan()
+        self.assertEqual(result.filePaths, paths('c.foo'))
+        self.assertEqual(
+            result.removedFilePaths, paths('a/b/e.foo', 'a/b/g.foo'))
+
+    def testFileIndexSkipsUnchangedDirectories(self):
+        tree = tempfile.mkdtemp('testFileIndexSkipsUnchangedDirectories')
+        utils.touch(os.path.join(tree, 'a.foo'))
+        os.utime(tree, (0, 0))
+        _, indexPath = tempfile.mkstemp()
+        fileIndex = utils.FileIndex(indexPath, tree, ['*.foo'])
+        fileIndex.scan()
+        with mock.patch('ga4gh.common.utils._scanDirectory') as scanMock:
+            result = fileIndex.scan()
+        self.assertEqual(scanMock.call_count, 0)
+        self.assertEqual(result.filePaths, [os.path.join(tree, 'a.foo')])
+        fileIndex.close()
+
     def testTouch(self):
         tree = tempfile.mkdtemp('testTouch')
         filePath = os.path.join(tree, 'touch.txt')
@@ -200,6 +828,34 @@ provider:
         with self.assertRaises(AssertionError):
             utils.assertFileContentsIdentical(pathFour, pathOne)
 
+    def testAssertFileContentsIdenticalBlocks(self):
+        lines = ['line {}\n'.format(i) for i in range(1000)]
+        _, pathOne = tempfile.mkstemp()
+        with open(pathOne, 'w') as fileOne:
+            fileOne.writelines(lines)
+        _, pathTwo = tempfile.mkstemp()
+        with gzip.open(pathTwo, 'w') as fileTwo:
+            fileTwo.writelines(lines)
+        utils.assertFileContentsIdentical(pathOne, pathTwo, blockSize=64)
+        lines[500] = 'line x\n'
+        _, pathThree = tempfile.mkstemp()
+        with open(pathThree, 'w') as fileThree:
+            fileThree.writelines(lines)
+        with self.assertRaises(AssertionError) as context:
+            utils.assertFileContentsIdentical(
+                pathTwo, pathThree, blockSize=64)
+        self.assertIn("line 501", str(context.exception))
+
+    def testAssertFileDigest(self):
+        _, path = tempfile.mkstemp()
+        with open(path, 'w') as fileHandle:
+            fileHandle.write('a')
+        digest = utils.getFileDigest(path, 'md5')
+        self.assertEqual(digest, '0cc175b9c0f1b6a831c399e269772661')
+        utils.assertFileDigest(path, digest, 'md5')
+        with self.assertRaises(AssertionError):
+            utils.assertFileDigest(path, 'notTheDigest', 'md5')
+
 
 class TestUtilsPrintMocked(AbstractTestUtils):
     """
@@ -221,10 +877,107 @@ class TestUtilsPrintMocked(AbstractTestUtils):
         self.assertEquals(aList, [1])
         self.assertEquals(self.printMock.call_count, 1)
 
+    def testTimedRegistry(self):
+        registry = utils.TimingRegistry()
+
+        @utils.Timed(report=False, registry=registry, name='recursive')
+        def recursiveFunc(depth):
+            if depth > 0:
+                recursiveFunc(depth - 1)
+        recursiveFunc(3)
+        stats = registry.getStats('recursive')
+        self.assertEqual(stats['count'], 4)
+        self.assertLessEqual(stats['minSeconds'], stats['p50Seconds'])
+        self.assertLessEqual(stats['p99Seconds'], stats['maxSeconds'])
+        self.assertIsNone(registry.getStats('notCalled'))
+        self.assertEqual(
+            json.loads(registry.toJson())['recursive']['count'], 4)
+        prometheus = registry.toPrometheus()
+        self.assertIn(
+            'ga4gh_function_seconds_count{function="recursive"} 4',
+            prometheus)
+        self.assertIn(
+            'ga4gh_function_seconds_bucket{function="recursive",le="+Inf"} 4',
+            prometheus)
+        registry.reset()
+        self.assertIsNone(registry.getStats('recursive'))
+
     @mock.patch('__builtin__.print', printMock)
     def testLog(self):
         utils.log("message")
         self.assertEquals(self.printMock.call_count, 1)
+        utils.log("message {} {value}", 1, value=2)
+        self.printMock.assert_called_with("message 1 2")
+
+    @mock.patch('__builtin__.print', printMock)
+    def testLogLevels(self):
+        self.addCleanup(utils.configureLogging)
+        utils.configureLogging(level=logging.WARNING)
+        formatCalls = []
+
+        class Formattable(object):
+            def __format__(self, formatSpec):
+                formatCalls.append(formatSpec)
+                return ''
+        utils.log("message {}", Formattable(), level=logging.INFO)
+        self.assertEquals(self.printMock.call_count, 0)
+        self.assertEquals(formatCalls, [])
+        utils.log("warning", level=logging.WARNING)
+        self.printMock.assert_called_once_with("warning")
+
+    @mock.patch('__builtin__.print', printMock)
+    def testLogStructuredAsynchronous(self):
+        self.addCleanup(utils.configureLogging)
+        utils.configureLogging(structured=True, asynchronous=True)
+        utils.log("message {}", 1)
+        # closing the asynchronous handler flushes it
+        utils.configureLogging()
+        self.assertEquals(self.printMock.call_count, 1)
+        record = json.loads(self.printMock.call_args[0][0])
+        self.assertEqual(record['message'], "message 1")
+        self.assertEqual(record['level'], "INFO")
+
+    @mock.patch('__builtin__.print', printMock)
+    def testLogAsynchronousException(self):
+        self.addCleanup(utils.configureLogging)
+        utils.configureLogging(structured=True, asynchronous=True)
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            utils._logger.exception("failed")
+        utils.configureLogging()
+        record = json.loads(self.printMock.call_args[0][0])
+        self.assertEqual(record['message'], "failed")
+        self.assertIn("ValueError: oops", record['exception'])
+
+    @mock.patch('__builtin__.print', printMock)
+    def testLogNonAscii(self):
+        # formatted messages are printed as UTF-8
+        utils.log("caf\xe9 {}", 1)
+        self.printMock.assert_called_with(b"caf\xc3\xa9 1")
+        utils.log("ok {}", "caf\xe9")
+        self.printMock.assert_called_with(b"ok caf\xc3\xa9")
+        utils.log("caf\xe9")
+        self.printMock.assert_called_with("caf\xe9")
+
+    def testLogNonAsciiToPipe(self):
+        # a pipe has no encoding, unlike the StringIO that nose swaps in
+        script = (
+            "import ga4gh.common.utils as utils\n"
+            "utils.log(b'bytes caf\\xc3\\xa9')\n"
+            "utils.log(u'\\xe9 {}', u'\\xe8')\n"
+            "utils.log(u'caf\\xe9')\n")
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        env.pop('PYTHONIOENCODING', None)
+        proc = subprocess.Popen(
+            [sys.executable, '-c', script], env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(stderr, b'')
+        self.assertEqual(
+            stdout, b'bytes caf\xc3\xa9\n\xc3\xa9 \xc3\xa8\ncaf\xc3\xa9\n')
 
     @mock.patch('__builtin__.print', printMock)
     def testRequireExecutables(self):
@@ -272,3 +1025,37 @@ class TestCaptureOutput(unittest.TestCase):
             func, "1", "2", "3", keywordTwo="5", keywordOne="4")
         self.assertEqual(stdout, "1 2 3 4 5\n")
         self.assertEqual(stderr, "")
+
+    def testCaptureNonAscii(self):
+        def func():
+            print('caf\xe9')
+            sys.stderr.write(b'bytes\n')
+        stdout, stderr = utils.captureOutput(func)
+        self.assertEqual(stdout, 'caf\xe9\n')
+        self.assertEqual(stderr, 'bytes\n')
+
+    def testCaptureInterleaved(self):
+        def func():
+            print('h\xe9llo')
+            subprocess.call(['echo', 'sub'])
+            print('after')
+        stdout, stderr = utils.captureOutput(func)
+        self.assertEqual(stdout, 'h\xe9llo\nsub\nafter\n')
+
+    def testCaptureSubprocess(self):
+        stdout, stderr = utils.captureOutput(
+            subprocess.call, "echo out; echo err 1>&2", shell=True)
+        self.assertEqual(stdout, "out\n")
+        self.assertEqual(stderr, "err\n")
+
+    def testCaptureFdOutput(self):
+        with utils.captureFdOutput(memoryThreshold=4) as captured:
+            os.write(1, b'stdout')
+            os.write(2, b'err')
+        self.assertEqual(captured.stdout[:], b'stdout')
+        self.assertEqual(len(captured.stdout), 6)
+        self.assertEqual(captured.stderr, b'err')
+        with utils.captureFdOutput(tailBytes=3) as captured:
+            os.write(1, b'stdout')
+        self.assertEqual(captured.stdout, b'out')
+        self.assertEqual(captured.stderr, b'')